@@ -1,89 +1,206 @@
-import socket
+# std
+import asyncio
+import json
 import threading
 
+# sekoia
+import eventlog
+
 HELP_STRING = """
 Commands :
 
-- ls : list services. '*' = bypassed, '~' = currently deploying
+- ls : list services. '*' = bypassed, '~' = currently deploying, '+' = waiting for its turn to deploy
 - bypass X : next deployment of X will be direct
 - nobypass X : next deployment of X will be normal
 - abort X : abort running deployment
+- tail X [N] : last N (20) log records of X
 """
 
+HTTP_HELP = {
+    "GET /services": "state of every service",
+    "GET /services/<name>": "state of one service",
+    "POST /services/<name>/bypass": "next deployment of the service will be direct",
+    "POST /services/<name>/nobypass": "next deployment of the service will be normal",
+    "POST /services/<name>/abort": "abort the running deployment of the service",
+    "GET /services/<name>/events?n=N": "last N (20) log records of the service",
+}
+
+TAIL = 20  # log records shown by default
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+
 
 class AdminServer:
-    def __init__(self, port, canaries):
+    # Serves the admin console (one command per line) on port, and the same commands as an HTTP/JSON API
+    # on httpPort, both on 127.0.0.1. Every client is served concurrently by an event loop of its own.
+    # Services are read from their snapshot, which needs no lock, see BirdWatcher.snapshot.
+    def __init__(self, port, canaries, httpPort=None):
         self.port = port
-        self.canaries = canaries
-        self.server_thread = threading.Thread(target=self.server)
+        self.httpPort = httpPort
+        self.canaries = canaries  # shared with Aviary, which adds and removes services
+        self.loop = asyncio.new_event_loop()
+        self.server_thread = threading.Thread(target=self.server, name="admin-server", daemon=True)
         self.server_thread.start()
-        self.server_thread.join()
-        print("AdminServer crashed")
 
     def server(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind(("127.0.0.1", self.port))
-            s.listen(1)
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(asyncio.start_server(self.console, "127.0.0.1", self.port))
+        if self.httpPort:
+            self.loop.run_until_complete(asyncio.start_server(self.http, "127.0.0.1", self.httpPort))
+        self.loop.run_forever()
 
+    def wait(self):
+        self.server_thread.join()
+        eventlog.warn("AdminServer", "AdminServer crashed")
+
+    async def console(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        eventlog.log("AdminServer", f"Connection from {addr}")
+        try:
+            writer.write(self.reply(HELP_STRING, prompt=False).encode("utf-8"))
+            writer.write(self.reply("List of services : ", prompt=False).encode("utf-8"))
+            writer.write(self.send_list().encode("utf-8"))
+            await writer.drain()
             while True:
-                self.conn, self.addr = s.accept()
-                with self.conn:
-                    print("[AdminServer] Connection from", self.addr)
-                    self.reply(HELP_STRING, prompt=False)
-                    self.reply("List of services : ", prompt=False)
-                    self.send_list()
-                    while True:
-                        data = self.conn.recv(1024)
-                        if not data:
-                            print("[AdminServer] Disconnect :", self.addr)
-                            break
-                        self.handle(data)
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write(self.handle(line).encode("utf-8"))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            eventlog.log("AdminServer", f"Disconnect : {addr}")
+            writer.close()
 
     def reply(self, data="", prompt=True):
         msg = data + "\n"
         if prompt:
             msg += "_> "
-        self.conn.sendall(msg.encode("utf-8"))
+        return msg
 
     def send_list(self):
         ls = ""
-        for i in range(len(self.canaries)):
-            c = self.canaries[i]
+        for i, c in enumerate(list(self.canaries)):
+            snapshot = c.snapshot()
             notes = ""
-            if c.bypass_next_deployment:
+            if snapshot["bypass_next_deployment"]:
                 notes += "*"
-            if c.deploying:
+            if snapshot["deploying"]:
                 notes += "~"
-            ls += f"[{i}] {notes}{c.baseDeploymentName}\n"
-        self.reply(ls)
+            if snapshot["queued"]:
+                notes += "+"
+            queued = f" (#{snapshot['queued']} in the rollout queue)" if snapshot["queued"] else ""
+            ls += f"[{i}] {notes}{c.baseDeploymentName}{queued}\n"
+        return self.reply(ls)
 
     def handle(self, data):
+        # one line of the console, returns the reply to send
         data = data.strip().decode()
         chunks = data.split()
         if not len(chunks):
-            self.reply()
-            return
-        if len(chunks) == 2:
+            return self.reply()
+        if len(chunks) in (2, 3):
             try:
-                canary_i = int(chunks[-1])
-                canary = self.canaries[canary_i]
+                canary_i = int(chunks[1])
+                canary = list(self.canaries)[canary_i]
                 canary_name = canary.baseDeploymentName
             except Exception:
-                self.reply("Invalid command.")
-                return
+                return self.reply("Invalid command.")
 
         if data == "ls":
             return self.send_list()
-        if chunks[0] == "bypass":
+        if len(chunks) == 2 and chunks[0] == "bypass":
             canary.bypass_next_deployment = True
             return self.reply(
                 f"Next deployment of {canary_name} will be done directly.\nCancel with 'nobypass {canary_i}'"
             )
-        if chunks[0] == "nobypass":
+        if len(chunks) == 2 and chunks[0] == "nobypass":
             canary.bypass_next_deployment = False
             return self.send_list()
-        if chunks[0] == "abort":
+        if len(chunks) == 2 and chunks[0] == "abort":
             canary.abort = True
             return self.reply(f"Aborting deployment of {canary_name} ...")
-        self.reply("Invalid command")
+        if len(chunks) in (2, 3) and chunks[0] == "tail":
+            try:
+                count = int(chunks[2]) if len(chunks) == 3 else TAIL
+            except ValueError:
+                return self.reply("Invalid command.")
+            return self.reply("".join(self.format_event(e) for e in self.events(canary, count)))
+        return self.reply("Invalid command")
+
+    def events(self, canary, count):
+        # the last count records the watcher logged, from its ring buffer
+        return list(canary.events)[-count:] if count > 0 else []
+
+    def format_event(self, event):
+        fields = "".join(f" {key}={event[key]}" for key in ("rollout", "step", "decision") if key in event)
+        return f"{event['time']} {event['level']:<7} {event['message']}{fields}\n"
+
+    async def http(self, reader, writer):
+        # one request per connection, enough for scripts and curl
+        try:
+            request = await reader.readline()
+            length = 0
+            while True:
+                header = await reader.readline()
+                if header in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = header.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value.strip())
+            if length:
+                await reader.readexactly(length)  # commands take no body
+            status, body = self.route(*(request.decode("latin-1").split() + ["", ""])[:2])
+            payload = json.dumps(body, indent=2).encode("utf-8") + b"\n"
+            writer.write(
+                f"HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("latin-1") + payload
+            )
+            await writer.drain()
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def route(self, method, path):
+        # returns (status, JSON body) of an HTTP request
+        path, _, query = path.partition("?")
+        parts = [p for p in path.split("/") if p]
+        if not parts or parts[0] != "services" or len(parts) > 3:
+            return 404, {"error": f"unknown path {path}", "endpoints": HTTP_HELP}
+        canaries = {c.baseDeploymentName: c for c in list(self.canaries)}
+        if len(parts) == 1:
+            if method != "GET":
+                return 405, {"error": f"{method} not allowed on {path}"}
+            return 200, [c.snapshot() for c in canaries.values()]
+        canary = canaries.get(parts[1])
+        if canary is None:
+            return 404, {"error": f"unknown service {parts[1]}"}
+        if len(parts) == 2:
+            if method != "GET":
+                return 405, {"error": f"{method} not allowed on {path}"}
+            return 200, canary.snapshot()
+
+        if parts[2] == "events":
+            if method != "GET":
+                return 405, {"error": f"{method} not allowed on {path}"}
+            params = dict(p.partition("=")[::2] for p in query.split("&") if p)
+            try:
+                count = int(params.get("n", TAIL))
+            except ValueError:
+                return 400, {"error": f"n must be a number, not {params['n']}"}
+            return 200, self.events(canary, count)
+        if method != "POST":
+            return 405, {"error": f"{method} not allowed on {path}"}
+        if parts[2] == "bypass":
+            canary.bypass_next_deployment = True
+        elif parts[2] == "nobypass":
+            canary.bypass_next_deployment = False
+        elif parts[2] == "abort":
+            if not canary.deploying:
+                return 400, {"error": f"{parts[1]} has no deployment in progress"}
+            canary.abort = True
+        else:
+            return 404, {"error": f"unknown command {parts[2]}", "endpoints": HTTP_HELP}
+        return 200, canary.snapshot()
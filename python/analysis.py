@@ -0,0 +1,69 @@
+# deps
+import numpy
+
+# std
+import re
+
+# Comparison of the canary against the primary: the samples of a range query are split between
+# the pods of both deployments, aggregated per deployment, and the canary passes if its aggregate
+# is within a relative tolerance of the primary's.
+#
+#   - expr: rate(http_errors_total{kubernetes_pod_name="<<pod>>"}[1m])
+#     compare: p95      # mean, max, min, or a percentile pNN
+#     tolerance: 10%    # how much worse than the primary the canary may be
+#     direction: lower  # lower (the default) or higher values are better
+#     margin: 0         # absolute slack on top of the tolerance, for baselines close to 0
+#     window: 5m        # range of the query, check_success_step_duration by default
+
+AGGREGATES = {"mean": numpy.nanmean, "max": numpy.nanmax, "min": numpy.nanmin}
+_PERCENTILE = re.compile(r"p(\d+(\.\d+)?)$")
+
+
+def isAggregate(name):
+    return name in AGGREGATES or bool(_PERCENTILE.match(name))
+
+
+def aggregate(name, values):
+    # values is a 1D array, NaN samples are left out
+    match = _PERCENTILE.match(name)
+    if match:
+        return float(numpy.nanpercentile(values, float(match.group(1))))
+    return float(AGGREGATES[name](values))
+
+
+def splitSamples(result, label, canaryPods):
+    # splits the series of a range query between canary pods and the others.
+    # Returns (canary samples, primary samples, canary pods that had samples)
+    canary, primary, seen = [], [], set()
+    for series in result:
+        pod = series["metric"][label]
+        values = numpy.array([value for _, value in series["values"]], dtype=float)
+        if pod in canaryPods:
+            canary += [values]
+            if len(values):
+                seen.add(pod)
+        else:
+            primary += [values]
+    return _concat(canary), _concat(primary), seen
+
+
+def compare(expr, canary, primary):
+    # verdict of one comparative expression from canary and primary samples, returns (success, reason)
+    if not numpy.any(~numpy.isnan(canary)):
+        return False, "no samples for canary pods"
+    if not numpy.any(~numpy.isnan(primary)):
+        return False, "no samples for primary pods, nothing to compare to"
+    canaryValue = aggregate(expr["compare"], canary)
+    primaryValue = aggregate(expr["compare"], primary)
+    if expr["direction"] == "lower":
+        limit = primaryValue + abs(primaryValue) * expr["tolerance"] + expr["margin"]
+        success = canaryValue <= limit
+    else:
+        limit = primaryValue - abs(primaryValue) * expr["tolerance"] - expr["margin"]
+        success = canaryValue >= limit
+    reason = f"{expr['compare']} of canary {canaryValue:.6g}, primary {primaryValue:.6g}, limit {limit:.6g}"
+    return success, reason
+
+
+def _concat(arrays):
+    return numpy.concatenate(arrays) if arrays else numpy.array([], dtype=float)
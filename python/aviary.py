@@ -1,45 +1,379 @@
 # std
+import copy
 import os
+import signal
+import socket
 import threading
-import yaml
+import traceback
 
 # sekoia
+import kubeclient
+import eventlog
+import metrics
+import tracing
 from prometheusclient import PrometheusClient
-from birdwatcher import BirdWatcher
+from releasetrain import ReleaseTrain
+from birdwatcher import BirdWatcher, ConfigError, toSeconds
+from configwatcher import ConfigWatcher, loadConfig
 from kubernetesinterface import KubernetesInterface
 from admin_server import AdminServer
+from engine import ENGINES
+from scheduler import RolloutScheduler, parseQuantity
+from shards import HashRing, ShardManager
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "config", "canaries.yaml")
+
+# settings the services of a group must agree on, for their steps and checks to run in lockstep
+GROUP_SETTINGS = ("start_delay", "check_success_step_duration", "max_step_duration", "check_max_failures")
 
 
 class Aviary:
     def __init__(self):
         self.canaries = []
-        self.threads = []
-        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "config", "canaries.yaml")) as f:
-            self.config = yaml.load(f.read(), Loader=yaml.SafeLoader)
+        self.config = loadConfig(CONFIG_PATH)
+        self.settings = self.globalSettings(self.config)  # only read on startup, see reload
+
+        metrics.start(self.config.pop("metrics-port", 8889))
+
+        # how BirdWatchers run: "threads" (one thread each) or "asyncio" (one event loop for all)
+        self.engine = ENGINES[self.config.pop("engine", "threads")](self.config.pop("engine-pool-size", 16))
+
+        self.prom = self.engine.adapt(
+            PrometheusClient(
+                self.config.pop("prometheus-base-url"),
+                concurrency=self.config.pop("prometheus-concurrency", 8),
+                timeout=toSeconds(self.config.pop("prometheus-timeout", 10)),
+                retries=self.config.pop("prometheus-retries", 3),
+                skewRefresh=toSeconds(self.config.pop("prometheus-skew-refresh", 300)),
+                cacheTTL=toSeconds(self.config.pop("prometheus-cache-ttl", 5)),
+            )
+        )
+
+        # spans of every rollout, written to a file per rollout when a directory is given, see tracing
+        tracing.configure(
+            self.config.pop("tracing-dir", None),
+            format=self.config.pop("tracing-format", "chrome"),
+            keep=self.config.pop("tracing-keep", 200),
+        )
+
+        # one connection per watcher sending requests at once, and a few for watches and leases
+        services = sum(isinstance(value, dict) for value in self.config.values())
+        kubeclient.configure(
+            poolSize=self.config.pop("kubernetes-pool-size", services + 8),
+            timeout=toSeconds(self.config.pop("kubernetes-timeout", 30)),
+        )
+
+        # one KubernetesInterface per namespace, created with the first service living in it
+        self.kubes = {}
+        self.namespace = self.config.pop("namespace", "sic")  # of services without a namespace of their own
+        self.writeMode = self.config.pop("kubernetes-write-mode", "patch")
+
+        # canary rollouts past these limits wait for their turn, see RolloutScheduler
+        self.scheduler = self.engine.adapt(
+            RolloutScheduler(
+                limit=self.config.pop("rollout-concurrency", None),
+                namespaceLimit=self.config.pop("rollout-namespace-concurrency", None),
+                cpuBudget=parseQuantity(self.config.pop("rollout-cpu-budget", None)),
+                memoryBudget=parseQuantity(self.config.pop("rollout-memory-budget", None)),
+            )
+        )
+
+        # services can be spread over several replicas of aviary, see ShardManager
+        shards = self.config.pop("shards", None)
+        leaseDuration = toSeconds(self.config.pop("shard-lease-duration", 15))
+        reloadInterval = toSeconds(self.config.pop("config-reload-interval", 10))
+        adminHttpPort = self.config.pop("admin-http-port", 8890)
+        self.initConcurrency = self.config.pop("init-concurrency", 16)  # services initialized side by side
+        # services of a group rolled out together, see ReleaseTrain
+        self.boarding = toSeconds(self.config.pop("release-train-boarding", 60))
+        self.trains = {}  # group -> its ReleaseTrain, adapted to the engine
+        self.kubesLock = threading.Lock()
+        self.lock = threading.Lock()  # guards canaries and services against shards and reloads
+        self.services = {}  # service -> its config from canaries.yaml, as written
+        self.ring = HashRing(shards) if shards is not None else None
+        self.byShard = {}  # shard -> services it holds
+        self.active = set()  # shards held by this replica
+        # watchers of services removed from canaries.yaml, or moved, finishing their rollout in progress.
+        # They stay in canaries for the admin console until their watch returns, see watch
+        self.leaving = {}  # service -> (BirdWatcher, shard)
+        self.deferred = {}  # service -> its new config, started once its leaving watcher returned
+
+        # rejects a bad canaries.yaml before starting anything
+        self.checkGroups({canary: self.checkConfig(canary, config) for canary, config in self.config.items()})
+        self.addServices(self.config)
+
+        if shards is not None:
+            self.shards = ShardManager(
+                shards,
+                os.environ.get("POD_NAMESPACE", self.namespace),
+                os.environ.get("POD_NAME", socket.gethostname()),
+                onAcquire=self.startShard,
+                onLose=self.stopShard,
+                canRelease=self.canReleaseShard,
+                leaseDuration=leaseDuration,
+            ).start()
+            signal.signal(signal.SIGTERM, self.terminate)
+
+        self.configWatcher = ConfigWatcher(CONFIG_PATH, self.reload, reloadInterval).start()
+        self.cli_server = AdminServer(8888, self.canaries, httpPort=adminHttpPort)
+
+    def globalSettings(self, config):
+        # services are mappings, everything else is a global setting
+        return {key: value for key, value in config.items() if not isinstance(value, dict)}
+
+    def checkConfig(self, deployment, config):
+        # returns the config of a service as BirdWatcher converts it, or raises ConfigError
+        if not isinstance(config, dict):
+            raise ConfigError(f"{deployment}: unknown global setting")
+        return BirdWatcher(deployment, copy.deepcopy(config), None, None, None).config
+
+    def checkGroups(self, converted):
+        # raises ConfigError if services of a group disagree on GROUP_SETTINGS. converted are the configs
+        # of every service as checkConfig returns them
+        groups = {}
+        for canary, config in converted.items():
+            if config["group"] is not None:
+                groups.setdefault(config["group"], []).append(canary)
+        for group, members in groups.items():
+            for key in GROUP_SETTINGS:
+                values = {canary: converted[canary][key] for canary in members}
+                if len(set(values.values())) > 1:
+                    raise ConfigError(f"services of group {group} must have the same {key}, not {values}")
 
-        self.prom = PrometheusClient(self.config["prometheus-base-url"])
-        del self.config["prometheus-base-url"]
+    def reload(self, config):
+        # applies a new canaries.yaml. Only the BirdWatchers of services whose config changed are touched,
+        # and they keep going with their current config until their rollout in progress is over
+        settings = self.globalSettings(config)
+        services = {key: value for key, value in config.items() if key not in settings}
+        try:
+            checked = {canary: self.checkConfig(canary, c) for canary, c in services.items()}
+            self.checkGroups(checked)
+        except ConfigError as e:
+            eventlog.warn("Aviary", f"Rejected the new configuration, keeping the current one: {e}")
+            return
+        for key in settings.keys() | self.settings.keys():
+            if settings.get(key) != self.settings.get(key):
+                eventlog.warn("Aviary", f"Global setting {key} changed, it will be applied on the next restart")
+        self.settings = settings
+        converted = {canary: c for canary, c in checked.items() if services[canary] != self.services.get(canary)}
 
-        self.kube = KubernetesInterface(namespace=self.config.get("namespace", "sic"))
-        del self.config["namespace"]
+        for canary in self.services.keys() - services.keys():
+            eventlog.log("Aviary", f"{canary} was removed", service=canary)
+            self.removeService(canary)
+        added = {}
+        for canary, config in converted.items():
+            if canary not in self.services:
+                eventlog.log("Aviary", f"{canary} was added", service=canary)
+                added[canary] = services[canary]
+            elif self.namespaceOf(config) != self.namespaceOf(self.services[canary]):
+                eventlog.log("Aviary", f"{canary} moved to namespace {self.namespaceOf(config)}", service=canary)
+                self.removeService(canary)
+                added[canary] = services[canary]
+            elif config["group"] != self.services[canary].get("group"):
+                eventlog.log("Aviary", f"{canary} moved to group {config['group']}", service=canary)
+                self.removeService(canary)
+                added[canary] = services[canary]
+            else:
+                eventlog.log("Aviary", f"{canary} was reconfigured", service=canary)
+                self.services[canary] = services[canary]
+                watcher = self.watcher(canary)
+                if watcher is not None:
+                    watcher.reconfigure(config)
+                with self.lock:
+                    if canary in self.deferred:
+                        self.deferred[canary] = services[canary]
+        self.addServices(added)
 
-        for canary in self.config.keys():
-            self.addCanary(canary, self.config[canary])
+    def namespaceOf(self, config):
+        return config.get("namespace", self.namespace)
 
-        self.cli_server = AdminServer(8888, self.canaries)
+    def shardKey(self, deployment, config):
+        # services of a group share their shard, their release train only runs within one replica
+        if config.get("group") is not None:
+            return f"group/{config['group']}"
+        return f"{self.namespaceOf(config)}/{deployment}"
 
-    def addCanary(self, deployment, config):
-        c = BirdWatcher(deployment, config, self.prom, self.kube)
-        if c.initCanary():
+    def train(self, group):
+        # the release train of group, None for services without group
+        if group is None:
+            return None
+        with self.lock:
+            if group not in self.trains:
+                self.trains[group] = self.engine.adapt(ReleaseTrain(group, self.boarding, self.scheduler.client))
+            return self.trains[group]
+
+    def watcher(self, deployment):
+        # the watcher of the service, not the one leaving it
+        with self.lock:
+            leaving = self.leaving.get(deployment, (None,))[0]
+            return next((c for c in self.canaries if c.baseDeploymentName == deployment and c is not leaving), None)
+
+    def addServices(self, services):
+        # registers services from canaries.yaml, and starts those of the shards this replica holds
+        # (all of them without shards)
+        # Services whose previous watcher is still leaving start once it returned, so that two watchers never
+        # drive the same deployments
+        start = []
+        with self.lock:
+            for deployment, config in services.items():
+                self.services[deployment] = config
+                shard = None
+                if self.ring is not None:
+                    shard = self.ring.shard(self.shardKey(deployment, config))
+                    self.byShard.setdefault(shard, set()).add(deployment)
+                if deployment in self.leaving:
+                    eventlog.log(
+                        "Aviary", f"{deployment} starts once its rollout in progress is over", service=deployment
+                    )
+                    self.deferred[deployment] = config
+                elif shard is None or shard in self.active:
+                    start += [(deployment, config, shard)]
+        self.addCanaries(start)
+
+    def removeService(self, deployment):
+        # the BirdWatcher of the service stops after its rollout in progress, if any
+        config = self.services.pop(deployment)
+        with self.lock:
+            shard = None
+            if self.ring is not None:
+                shard = self.ring.shard(self.shardKey(deployment, config))
+                self.byShard[shard].discard(deployment)
+            self.deferred.pop(deployment, None)
+            for c in [c for c in self.canaries if c.baseDeploymentName == deployment]:
+                c.reconfigure(None)
+                self.leaving[deployment] = (c, shard)
+
+    async def watch(self, c):
+        # watch of the watcher, then the service starts again if it was added back while its watcher was leaving.
+        # An error ending the watch is logged here: engines keep it in the task, where nothing reads it until exit
+        try:
+            await c.watch()
+        except Exception as e:
+            c.log(
+                f"Stopped watching after an unexpected error, {type(e).__name__}: {e}",
+                level="error",
+                traceback=traceback.format_exc(),
+            )
+        finally:
+            with self.lock:
+                if c in self.canaries:
+                    self.canaries.remove(c)
+                deployment = c.baseDeploymentName
+                config = None
+                if self.leaving.get(deployment, (None,))[0] is c:
+                    del self.leaving[deployment]
+                    config = self.deferred.pop(deployment, None)
+            if config is not None:
+                await self.restart(deployment, config)
+
+    async def restart(self, deployment, config):
+        # starts a service added back while its previous watcher was leaving, as addCanaries would
+        with self.lock:
+            shard = self.ring.shard(self.shardKey(deployment, config)) if self.ring is not None else None
+            if shard is not None and shard not in self.active:
+                return
+        c = self.newWatcher(deployment, copy.deepcopy(config))
+        initialized, _ = await self.initCanary(c)
+        if initialized:
+            self.startWatcher(c, shard)
+
+    def kube(self, namespace):
+        # the first service of a namespace starts its informers, which LIST every deployment and pod in it
+        with self.kubesLock:
+            if namespace not in self.kubes:
+                self.kubes[namespace] = self.engine.adapt(
+                    KubernetesInterface(namespace=namespace, writeMode=self.writeMode)
+                )
+            return self.kubes[namespace]
+
+    def addCanaries(self, services):
+        # initializes services side by side, init-concurrency at a time, then watches them.
+        # services are (deployment, config, shard), shard is None when services aren't sharded.
+        # BirdWatcher converts its config in place, each start gets a fresh copy
+        watchers = [
+            (self.newWatcher(deployment, copy.deepcopy(config)), shard) for deployment, config, shard in services
+        ]
+        if not watchers:
+            return
+        start = self.engine.time()
+        timings = self.engine.gather([self.initCanary(c) for c, _ in watchers], self.initConcurrency)
+        for (c, shard), (initialized, _) in zip(watchers, timings):
+            if initialized:
+                self.startWatcher(c, shard)
+        slowest, (_, seconds) = max(zip(watchers, timings), key=lambda w: w[1][1])
+        eventlog.log(
+            "Aviary",
+            f"Initialized {len(watchers)} services in {self.engine.time() - start:.1f}s, "
+            f"the slowest was {slowest[0].baseDeploymentName} in {seconds:.1f}s",
+        )
+
+    def startWatcher(self, c, shard):
+        with self.lock:
+            if shard is not None and shard not in self.active:  # lost while initializing
+                return
             self.canaries += [c]
-            self.threads += [threading.Thread(target=c.watch)]
-            self.threads[-1].start()
-            return c
-        return False
+        self.engine.spawn(self.watch(c), name=c.baseDeploymentName)
+
+    def newWatcher(self, deployment, config):
+        return BirdWatcher(
+            deployment,
+            config,
+            self.prom,
+            self.kube(self.namespaceOf(config)),
+            self.engine,
+            self.scheduler,
+            self.train(config.get("group")),
+        )
+
+    async def initCanary(self, c):
+        # initCanary of one service, with its duration
+        start = self.engine.time()
+        try:
+            initialized = await c.initCanary()
+        except Exception as e:
+            c.warn(f"Couldn't initialize: {e}")
+            initialized = False
+        seconds = self.engine.time() - start
+        c.log(f"Initialized in {seconds:.1f}s" if initialized else f"Gave up initializing after {seconds:.1f}s")
+        return initialized, seconds
+
+    def startShard(self, shard):
+        # called by the ShardManager, which must go on renewing its Leases while the services initialize
+        with self.lock:
+            self.active.add(shard)
+        threading.Thread(target=self._startShard, args=(shard,), name=f"shard-{shard}", daemon=True).start()
+
+    def _startShard(self, shard):
+        with self.lock:
+            services = [(d, self.services[d], shard) for d in self.byShard.get(shard, ()) if d in self.services]
+        self.addCanaries(services)
+
+    def stopShard(self, shard):
+        with self.lock:
+            self.active.discard(shard)
+            names = self.byShard.get(shard, set())
+            leaving = [c for c, s in self.leaving.values() if s == shard]
+            for c in [c for c in self.canaries if c.baseDeploymentName in names or c in leaving]:
+                c.stop()
+                self.canaries.remove(c)
+
+    def canReleaseShard(self, shard):
+        # shards are handed over between rollouts only
+        with self.lock:
+            names = self.byShard.get(shard, set())
+            leaving = [c for c, s in self.leaving.values() if s == shard]
+            return not any(c.deploying for c in self.canaries if c.baseDeploymentName in names or c in leaving)
+
+    def terminate(self, signum, frame):
+        # the replica leaves the shards, then dies of SIGTERM as it would have without this handler
+        self.shards.leave()
+        eventlog.flush()
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
 
     def wait(self):
-        for t in self.threads:
-            t.join()
+        self.engine.wait()
+        self.cli_server.wait()  # with shards, watchers may come later
 
 
 a = Aviary()
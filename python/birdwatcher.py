@@ -1,52 +1,130 @@
-# deps
-from deepdiff import DeepDiff
-
 # std
+import collections
+import json
 import math
-import time
-import copy
-import fnmatch
 import re
+import copy
 import uuid
 import datetime
 
+# sekoia
+import analysis
+import eventlog
+import metrics
+import promql
+import tracing
+from kubeclient import client
+from classifier import ChangeClassifier
+from notifier import Notifier
+from prometheusclient import PrometheusError
+from scheduler import parseQuantity
+
+
+class ConfigError(Exception):
+    # the config of a service in canaries.yaml can't be used
+    pass
+
+
+# annotation of the canary deployment holding the state of the rollout in progress, see checkpoint
+CHECKPOINT = "aviary-rollout"
+
+# decisions and log records of a service kept for the admin server
+DECISIONS_KEPT = 20
+EVENTS_KEPT = 200
+
+# seconds between two checks of BirdWatcher.stopped while waiting for changes
+STOP_POLL = 5
+
+
+def toSeconds(duration):
+    # "90s", "10m" or "1h" from canaries.yaml to a number of seconds. Plain numbers are seconds already
+    if isinstance(duration, (int, float)):
+        return duration
+    return int(duration[:-1]) * {"s": 1, "m": 60, "h": 3600}[duration[-1]]
+
+
+def toRatio(percent):
+    # "10%" or "0.5%" from canaries.yaml to a fraction
+    return float(percent[:-1]) / 100
+
 
 class BirdWatcher:
-    def __init__(self, deployment, config, prom, kube):
+    def __init__(self, deployment, config, prom, kube, engine, scheduler=None, train=None):
         self.baseDeploymentName = deployment  # original deployment name
         self.primaryName = deployment + "-primary"  # primary deployment name
         self.canaryName = deployment + "-canary"  # canary deployment name
         self.replicas = 0  # replicas on original deployment
-        self.originalBaseDeployment = {}  # used to watch changes to original deployment
-        self.prom = prom  # instance of PrometheusClient
-        self.kube = kube
+        # used to watch changes to original deployment, instead of keeping the whole object
+        self.baseFingerprint = None  # what the original deployment contains, see ChangeClassifier
+        self.baseRevision = None  # (uid, generation) of the original deployment it was taken from
+        self.prom = prom  # instance of PrometheusClient, adapted to the engine
+        self.kube = kube  # instance of KubernetesInterface, adapted to the engine
+        self.engine = engine  # runs this watcher, see engine.py
+        self.scheduler = scheduler  # RolloutScheduler adapted to the engine, None to start rollouts at once
+        self.train = train  # ReleaseTrain of the group of the service adapted to the engine, None without group
+        self.run = None  # of the release train, while the service rides it
 
         # admin console flags
         self.bypass_next_deployment = False
         self.abort = False
         self.deploying = False
+        self.stopped = False  # set by stop, when another replica of aviary takes the service over
+        self.pendingConfig = None  # (config,) given to reconfigure, applied between rollouts
+        self.resume = None  # checkpoint of a rollout interrupted by a restart, resumed by watch
+        # read by the admin server from other threads, see snapshot. Both are replaced, never mutated
+        self.progress = None  # state of the rollout in progress, as saved by checkpoint
+        self.decisions = ()  # last (time, decision) of the service, most recent last
+        self.ticket = None  # of the rollout waiting for its turn or running, see RolloutScheduler
+        self.events = collections.deque(maxlen=EVENTS_KEPT)  # last records of log, read by the admin console
+        # first fault of a canary pod seen during the rollout, set from the pod informer, see onPodFault
+        self.fault = None
+        self.alarm = Notifier()  # notified when fault is set, wakes up the waits of deployCanary
 
         self.config = self._convertConfig(config)  # config from canaries.yaml
+        # decides how changes are deployed, see shouldDeploy
+        self.classifier = ChangeClassifier(self.config.get("canary_paths"), self.config.get("ignore_paths"))
 
     def _convertConfig(self, config):
-        config["breakpoint"] = int(config["breakpoint"][:-1]) / 100
-        config["step"] = int(config["step"][:-1]) / 100
-        config["max_step_duration"] = (
-            int(config["max_step_duration"][:-1]) * {"s": 1, "m": 60, "h": 3600}[config["max_step_duration"][-1]]
-        )
-        config["abort"] = int(config["abort"][:-1]) * {"s": 1, "m": 60, "h": 3600}[config["abort"][-1]]
-        config["check_success_step_duration"] = (
-            int(config["check_success_step_duration"][:-1])
-            * {"s": 1, "m": 60, "h": 3600}[config["check_success_step_duration"][-1]]
-        )
+        # raises ConfigError on missing or malformed values, before anything runs with them
+        try:
+            return self._convertValues(config)
+        except ConfigError as e:
+            raise ConfigError(f"{self.baseDeploymentName}: {e}") from e
+        except (KeyError, ValueError, TypeError, IndexError, AttributeError, re.error) as e:
+            raise ConfigError(f"{self.baseDeploymentName}: {type(e).__name__} {e}") from e
+
+    def _convertValues(self, config):
+        config["breakpoint"] = toRatio(config["breakpoint"])
+        config["step"] = toRatio(config["step"])
+        # adaptive progression: a step ends after step_growth_after consecutive healthy checks,
+        # and the next one is step_growth times larger. Any failed check falls back to step
+        config["step_growth_after"] = config.get("step_growth_after", 0)  # 0 keeps fixed steps
+        growthAfter = config["step_growth_after"]
+        if isinstance(growthAfter, bool) or not isinstance(growthAfter, int) or growthAfter < 0:
+            raise ConfigError(f"step_growth_after must be a number of checks, not {growthAfter!r}")
+        config["step_growth"] = float(config.get("step_growth", 2))
+        if not config["step_growth"] > 1:
+            raise ConfigError(f"step_growth must be more than 1, not {config['step_growth']}")
+        # promotes before the breakpoint once the failure rate of the canary is known to be under
+        # early_promotion, at a 95% confidence, from consecutive healthy checks (rule of three)
+        config["early_promotion"] = toRatio(config["early_promotion"]) if config.get("early_promotion") else 0
+        config["max_step_duration"] = toSeconds(config["max_step_duration"])
+        config["abort"] = toSeconds(config["abort"])
+        config["check_success_step_duration"] = toSeconds(config["check_success_step_duration"])
         config["check_max_failures"] = config.get("check_max_failures", 1)
-
-        if config.get("start_delay"):
-            config["start_delay"] = (
-                int(config["start_delay"][:-1]) * {"s": 1, "m": 60, "h": 3600}[config["start_delay"][-1]]
-            )
-        else:
-            config["start_delay"] = 0
+        config["start_delay"] = toSeconds(config.get("start_delay") or 0)
+        config["priority"] = int(config.get("priority", 0))  # rollouts of higher priority start first
+        config["group"] = config.get("group")  # services rolled out together, see ReleaseTrain
+        for key in ("canary_paths", "ignore_paths"):  # globs of ChangeClassifier
+            paths = config.get(key)
+            if paths is not None and (not isinstance(paths, list) or not all(isinstance(p, str) for p in paths)):
+                raise ConfigError(f"{key} must be a list of paths, not {paths!r}")
+        if config["group"] is not None and not isinstance(config["group"], str):
+            raise ConfigError(f"group must be a name, not {config['group']}")
+        for expr in config["success"]:
+            expr["template"] = promql.QueryTemplate(expr["expr"])  # rendered for the pods of each check
+            if "compare" in expr:
+                self._convertComparison(expr, config["check_success_step_duration"])
 
         # check unbounded value that could lead to ever success of deployment
         m = config["check_max_failures"] * config["check_success_step_duration"]
@@ -60,289 +138,781 @@ class BirdWatcher:
             config["max_step_duration"] = m + 1
         return config
 
-    def log(self, *args):
-        print(f"[{self.baseDeploymentName}]: ", *args)
-
-    def warn(self, *args):
-        print(f"[WARN {self.baseDeploymentName}]: ", *args)
-
-    def initCanary(self):
+    def _convertComparison(self, expr, window):
+        # expressions with a "compare" aggregate are checked against the primary, see analysis
+        if not analysis.isAggregate(expr["compare"]):
+            raise ConfigError(f"unknown aggregate '{expr['compare']}' in {expr['expr']}")
+        if expr.get("direction", "lower") not in ("lower", "higher"):
+            raise ConfigError(f"direction of {expr['expr']} must be 'lower' or 'higher'")
+        if not expr["template"].batchable:
+            raise ConfigError(f'{expr["expr"]} must select pods with label="{promql.POD_TAG}" to be compared')
+        expr["tolerance"] = toRatio(expr.get("tolerance", "10%"))
+        expr["direction"] = expr.get("direction", "lower")
+        expr["margin"] = float(expr.get("margin", 0))
+        expr["window"] = toSeconds(expr.get("window", window))
+        expr["resolution"] = toSeconds(expr.get("resolution", "15s"))
+
+    def log(self, *args, level="info", **fields):
+        # writes a record to the event log, and keeps it for the admin console. Records of a rollout
+        # carry its id (the aviary-id annotation it started with) and the canary instances of its step
+        progress = self.progress
+        if progress is not None:
+            fields = dict({"rollout": progress.get("rollout"), "step": progress["canary"]}, **fields)
+        message = " ".join(str(arg) for arg in args)
+        self.events.append(eventlog.log("BirdWatcher", message, level, service=self.baseDeploymentName, **fields))
+
+    def warn(self, *args, **fields):
+        self.log(*args, level="warning", **fields)
+
+    async def initCanary(self):
         # To perform a canary deployment, we need :
         # - The original deployment scaled to 0
         # - A copy of the original deployment, the primary
         # - A copy of the new deployment, the canary
-        # This checks if this is already set up, and applies it otherwise
-        if not self.kube.isDeployExists(self.baseDeploymentName):
+        # This checks if this is already set up, and applies it otherwise.
+        # Everything is read from the informer caches, filled by one LIST of the namespace, and never mutated:
+        # cleanupDeploy shares the spec, and copies it shallowly to change its replicas
+        if not await self.kube.isDeployExists(self.baseDeploymentName):
             self.log("Couldn't find deployment")
             return False
-        deployment = self.kube.getDeploy(self.baseDeploymentName)
+        deployment = await self.kube.getCachedDeploy(self.baseDeploymentName)
         # check if deployment is already ready for the canary setup
         if (
             deployment.spec.replicas == 0
-            and self.kube.isDeployExists(self.primaryName)
-            and self.kube.isDeployExists(self.canaryName)
+            and await self.kube.isDeployExists(self.primaryName)
+            and await self.kube.isDeployExists(self.canaryName)
         ):
-            return self._checkCanaryInit()
+            checkpoint = self.readCheckpoint(await self.kube.getCachedDeploy(self.canaryName), deployment)
+            if checkpoint is not None:
+                self.log(f"Found a canary rollout interrupted at {checkpoint['canary']} instances, resuming it")
+                self.replicas = checkpoint["replicas"]
+                self.resume = checkpoint
+                return True
+            return await self._checkCanaryInit()
 
         self.replicas = deployment.spec.replicas
 
         self.log("Creating mirror and canary deployments ...")
-        canary = copy.deepcopy(deployment)
-        primary = copy.deepcopy(deployment)
-        primary.metadata.name = self.primaryName
-        self.kube.deploy(self.cleanupDeploy(primary))
-
-        canary.metadata.name = self.canaryName
-        canary.spec.replicas = 0
-        self.kube.deploy(self.cleanupDeploy(canary))
+        await self.kube.deploy(self.cleanupDeploy(deployment, self.primaryName))
+        await self.kube.deploy(self.cleanupDeploy(deployment, self.canaryName, replicas=0))
         # scale base deploy to 0
-        self.kube.scaleDeploy(self.baseDeploymentName, 0)
+        await self.kube.scaleDeploy(self.baseDeploymentName, 0)
         self.log(
-            "All primaries ready after {}s, scaling OG to 0".format(self.kube.waitDeploymentReady(self.primaryName))
+            "All primaries ready after {}s, scaling OG to 0".format(
+                await self.kube.waitDeploymentReady(self.primaryName)
+            )
         )
         return True
 
-    def _checkCanaryInit(self):
+    async def _checkCanaryInit(self):
         # We are in init phase, check if leftover canary has been running
         # if it's the case scale primary to canary + primary (risk of having
         # nominal +1 instances). rollback primary to base deploy (if canary
         # exist, may be because failure happened during rollout).
         self.log("Canary setup looks initalized already")
-        if self.kube.getReplicas(self.canaryName) != 0:
+        if await self.kube.getReplicas(self.canaryName) != 0:
             self.log("Found leftovers of canary rollout, rolling back to original primary only")
-            self.kube.scaleDeploy(
-                self.primaryName, self.kube.getReplicas(self.canaryName) + self.kube.getReplicas(self.primaryName),
+            await self.kube.scaleDeploy(
+                self.primaryName,
+                await self.kube.getReplicas(self.canaryName) + await self.kube.getReplicas(self.primaryName),
             )
-            self.rollbackBaseDeployment()
-            self.kube.scaleDeploy(self.canaryName, 0)
-            self.log("done in {}s".format(self.kube.waitDeploymentReady(self.primaryName)))
+            await self.rollbackBaseDeployment()
+            await self.kube.scaleDeploy(self.canaryName, 0)
+            self.log("done in {}s".format(await self.kube.waitDeploymentReady(self.primaryName)))
         # get the goal of wanted replicas from primary deployment
-        deployment = self.kube.getDeploy(self.primaryName)
+        deployment = await self.kube.getCachedDeploy(self.primaryName)
         self.replicas = deployment.spec.replicas
         return True
 
-    def watch(self):
-        # This checks changes on the original deployment every 2 seconds,
+    async def watch(self):
+        # This wakes up on every change the shared informer sees on the original deployment,
         # and triggers direct or canary deployment following the output of shouldDeploy
         self.log("Watching changes on OG deployment ...")
-        self.originalBaseDeployment = self.kube.getDeploy(self.baseDeploymentName)
+        self.rememberBase(await self.kube.getCachedDeploy(self.baseDeploymentName))
+        if self.resume is not None:
+            resume, self.resume = self.resume, None
+            await self.scheduledCanary(resume)
+            self.deploying = False
 
-        while 1:
-            """deployment = self.api.list_namespaced_deployment(
-                namespace="sic", field_selector="metadata.name={}".format(service)
-            ).items[0]"""
-            baseDeployment = self.kube.getDeploy(self.baseDeploymentName)
+        while not self.stopped:
+            await self.applyPendingConfig()
+            if self.stopped:
+                break
+            # the informer copy is only read to fingerprint it, rollouts fetch their own
+            cached = await self.kube.waitDeployChange(self.baseDeploymentName, *self.baseRevision, timeout=STOP_POLL)
+            if cached is None:
+                continue
+            receivedAt = self.kube.receivedAt(self.baseDeploymentName)
+            if receivedAt is not None:
+                metrics.WATCH_LAG.labels(self.baseDeploymentName).observe(max(0, self.engine.time() - receivedAt))
+            newFingerprint = self.classifier.fingerprint(self.kube.toDict(cached))
 
-            if baseDeployment.spec != self.originalBaseDeployment.spec:
-                decision = self.shouldDeploy(self.originalBaseDeployment, baseDeployment)
+            if newFingerprint != self.baseFingerprint:
+                decision = self.shouldDeploy(self.baseFingerprint, newFingerprint)
                 if decision == "canary":
-                    self.deployCanary(baseDeployment)
+                    await self.scheduledCanary()
                 elif decision == "direct":
                     self.log("Deploying directly")
-                    self.deployDirect(baseDeployment)
+                    await self.deployDirect(await self.kube.getDeploy(self.baseDeploymentName))
                 elif decision == "scale":
-                    self.log("Scaling primary to {} instances".format(baseDeployment.spec.replicas))
-                    self.kube.scaleDeploy(self.baseDeploymentName, 0)
-                    self.kube.scaleDeploy(self.primaryName, baseDeployment.spec.replicas)
-                    self.replicas = baseDeployment.spec.replicas
+                    self.log("Scaling primary to {} instances".format(newFingerprint.replicas))
+                    await self.kube.scaleDeploy(self.baseDeploymentName, 0)
+                    await self.kube.scaleDeploy(self.primaryName, newFingerprint.replicas)
+                    self.replicas = newFingerprint.replicas
                 else:
                     self.log("ignoring")
-                self.originalBaseDeployment = self.kube.getDeploy(self.baseDeploymentName)
+                self.rememberBase(await self.kube.getDeploy(self.baseDeploymentName))
             else:
-                time.sleep(1)
-            time.sleep(2)
+                # nothing that matters changed, remember the generation so we don't wake up for it again
+                self.baseRevision = (cached.metadata.uid, cached.metadata.generation)
             self.deploying = False
 
-    def shouldDeploy(self, baseDeployment, newDeployment):
+    def stop(self):
+        # leaves the rollout in progress as it is: its waits are woken up and it returns before its next write.
+        # An idle watch returns within STOP_POLL seconds
+        self.stopped = True
+        self.halt()
+
+    def reconfigure(self, config):
+        # takes a new config from canaries.yaml, already converted by _convertConfig, or None to stop watching.
+        # It is applied by watch between rollouts, a rollout in progress keeps the config it started with
+        self.pendingConfig = (config,)
+
+    async def applyPendingConfig(self):
+        if self.pendingConfig is None:
+            return
+        (config,), self.pendingConfig = self.pendingConfig, None
+        if config is None:
+            self.log("Removed from the configuration, not watching anymore")
+            self.stop()
+            return
+        paths = (self.config.get("canary_paths"), self.config.get("ignore_paths"))
+        self.config = config
+        self.log("Configuration reloaded")
+        if paths != (self.config.get("canary_paths"), self.config.get("ignore_paths")):
+            # the deployment as it is now becomes the base of the new fingerprints
+            self.classifier = ChangeClassifier(self.config.get("canary_paths"), self.config.get("ignore_paths"))
+            self.rememberBase(await self.kube.getDeploy(self.baseDeploymentName))
+
+    def shouldDeploy(self, baseFingerprint, newFingerprint):
         # This tries to decide if an observed change to the original deployment should be deployed directly
         # or using a progressive rollout (canary)
         # No change to the original deployment should be ignored,
-        # but some path are just k8s versioning and should not be taken into account (ignorePath)
+        # but some path are just k8s versioning and should not be taken into account (ignore_paths)
         if self.bypass_next_deployment:
             self.bypass_next_deployment = False
             self.log("Canary deployment bypassed as configured by admin console")
+            self.recordDecision("bypass")
             return "direct"
 
-        canaryPath = [
-            "root._spec._template._spec._containers*",
-            "root._spec._template._spec._init_containers*",
-        ]  # support glob matching
-        ignorePath = [
-            "root._metadata._resource_version",
-            "root._metadata._generation",
-            "root._metadata._annotations._deployment.*",
-            "root._status*",
-        ]
-        scalePath = "root._spec._replicas"
-
-        contains_scale = False  # if scaling the base deployment, report scale on primary and scale down base.
-        skip = True  # a flag set to False whenever a meaningful change is detected
-        canaryPathRE = [re.compile(fnmatch.translate(cp).replace("[", "\\[").replace("]", "\\]")) for cp in canaryPath]
-
-        ignorePathRE = [re.compile(fnmatch.translate(cp).replace("[", "\\[").replace("]", "\\]")) for cp in ignorePath]
-
-        diff = DeepDiff(baseDeployment, newDeployment)
-        values_changed = diff["values_changed"]
-
-        if diff.get("type_changes"):
-            values_changed.update(diff["type_changes"])
-
-        for key, changes in values_changed.items():
-            # decide if observed change should be ignored
-            ignore = False
-            for ipathRE in ignorePathRE:
-                if ipathRE.match(key):
-                    ignore = True
-            if ignore:
-                continue
-            self.log(
-                "Saw changes to", key, "({} -> {})".format(changes["old_value"], changes["new_value"]),
-            )
-
-            if key == scalePath and changes["new_value"] != 0:  # og deployment was scaled manually
-                contains_scale = True
-            elif key == scalePath and changes["new_value"] == 0:  # og deployment was rescaled to 0 by aviary, skip
-                contains_scale = False
-            else:
-                skip = False
-
-            for pathRE in canaryPathRE:
-                if pathRE.match(key):
-                    return "canary"
-        if contains_scale and skip:  # skip will always be true if kubectl scale was called on the original deployment
-            return "scale"
-        return "direct" if not skip else ""
+        if baseFingerprint.images != newFingerprint.images:
+            self.log(f"Saw changes to images ({baseFingerprint.images} -> {newFingerprint.images})")
+        elif baseFingerprint.canary != newFingerprint.canary:
+            self.log("Saw changes to containers")
+        if baseFingerprint.other != newFingerprint.other:
+            self.log("Saw changes outside of containers")
+        if baseFingerprint.replicas != newFingerprint.replicas:
+            self.log(f"Saw changes to replicas ({baseFingerprint.replicas} -> {newFingerprint.replicas})")
+        decision = self.classifier.classify(baseFingerprint, newFingerprint)
+        self.recordDecision(decision or "ignore")
+        return decision
+
+    def recordDecision(self, decision):
+        metrics.DECISIONS.labels(self.baseDeploymentName, decision).inc()
+        self.decisions = (self.decisions + ((self.engine.time(), decision),))[-DECISIONS_KEPT:]
+        self.log(f"Decision: {decision}", decision=decision)
+        tracing.annotate(decision=decision)
+
+    def snapshot(self):
+        # state of the service for the admin server. What is read here is replaced as a whole
+        # by the watcher, never mutated, so any thread can read it without locks. Only the position in the
+        # rollout queue is asked to the scheduler
+        progress = self.progress
+        ticket = self.ticket
+        if progress is not None:
+            progress = dict(progress, breakpoint=math.ceil(progress["replicas"] * self.config["breakpoint"]))
+        return {
+            "service": self.baseDeploymentName,
+            "namespace": self.kube.namespace,
+            "replicas": self.replicas,
+            "deploying": self.deploying,
+            "queued": None if ticket is None else self.scheduler.position(ticket),
+            "group": self.config["group"],
+            "bypass_next_deployment": self.bypass_next_deployment,
+            "rollout": progress,
+            "decisions": [{"time": t, "decision": d} for t, d in self.decisions],
+        }
+
+    def rolloutAnnotations(self):
+        # marks every write of a rollout with a new id
+        return {"aviary-id": str(uuid.uuid4())}
 
     def prepareDeploy(self, deployment):
-        deployment.metadata.annotations["aviary-id"] = str(uuid.uuid4())
+        deployment.metadata.annotations.update(self.rolloutAnnotations())
         return deployment
 
-    def cleanupDeploy(self, deployment):
-        deployment = copy.deepcopy(deployment)
-        deployment.metadata.uid = None
-        deployment.metadata.self_link = None
-        deployment.metadata.generation = 0
-        deployment.metadata.creation_timestamp = None
-        deployment.metadata.resource_version = None
-        deployment = self.prepareDeploy(deployment)
-        return deployment
+    def rememberBase(self, deployment):
+        self.baseFingerprint = self.classifier.fingerprint(self.kube.toDict(deployment))
+        self.baseRevision = (deployment.metadata.uid, deployment.metadata.generation)
+
+    def cleanupDeploy(self, deployment, name, replicas=None):
+        # a new deployment named name, with the spec of deployment. The spec is shared,
+        # only copied shallowly when replicas is changed, and the metadata is rebuilt
+        # without the fields set by the API server.
+        spec = deployment.spec
+        if replicas is not None:
+            spec = copy.copy(spec)
+            spec.replicas = replicas
+        metadata = deployment.metadata
+        metadata = client.V1ObjectMeta(
+            name=name,
+            namespace=metadata.namespace,
+            labels=metadata.labels,
+            annotations=dict(metadata.annotations or {}),
+        )
+        return self.prepareDeploy(
+            client.V1Deployment(api_version="apps/v1", kind="Deployment", metadata=metadata, spec=spec)
+        )
 
-    def deployDirect(self, baseDeployment):
+    async def deployDirect(self, baseDeployment):
         # handle a direct deployment to the primary deployment, without canary
-        # get primary deployment and put the base.spec into primary.spec
-        primary = self.kube.getDeploy(self.primaryName)
-        primary.spec = baseDeployment.spec
+        # put the base.spec into primary.spec
+        spec = copy.copy(baseDeployment.spec)
 
         # scale base deploy to 0 (apply stack raise the scale)
-        self.kube.scaleDeploy(self.baseDeploymentName, 0)
+        await self.kube.scaleDeploy(self.baseDeploymentName, 0)
 
         # set primary replicas number to expected value
-        primary.spec.replicas = self.replicas
-        self.kube.deploy(self.prepareDeploy(primary))
+        spec.replicas = self.replicas
+        await self.kube.applySpec(self.primaryName, spec, self.rolloutAnnotations())
+
+    async def scheduledCanary(self, resume=None):
+        # deployCanary once the rollout scheduler lets it start. Waiting in the queue ends early
+        # on stop, leaving the change to the next owner, and on abort, which deployCanary rolls back.
+        # The rollout is traced from here, its wait in the queue included, see tracing
+        with tracing.trace("rollout", service=self.baseDeploymentName, namespace=self.kube.namespace):
+            if self.train is not None:
+                return await self.trainCanary(resume)
+            if self.scheduler is None:
+                return await self.deployCanary(resume)
+            cpu, memory = await self.stepRequests()
+            self.ticket = self.scheduler.enqueue(
+                f"{self.kube.namespace}/{self.baseDeploymentName}",
+                self.kube.namespace,
+                self.config["priority"],
+                cpu,
+                memory,
+            )
+            try:
+                start = self.engine.time()
+                if not self.ticket.admitted:
+                    self.log(f"Waiting for its turn to roll out, {self.scheduler.position(self.ticket)} in the queue")
+                with tracing.span("queued"):
+                    while not await self.scheduler.admit(self.ticket, STOP_POLL):
+                        if self.stopped:
+                            return
+                        if self.abort:
+                            break
+                if self.ticket.admitted and self.engine.time() - start >= 1:
+                    self.log(f"Waited {round(self.engine.time() - start)}s for its turn")
+                await self.deployCanary(resume)
+            finally:
+                self.scheduler.release(self.ticket)
+                self.ticket = None
+
+    async def trainCanary(self, resume=None):
+        # deployCanary in lockstep with the services of the group whose base deployment changed within the
+        # boarding time of the release train, see ReleaseTrain. The group waits for its turn as one rollout
+        cpu, memory = await self.stepRequests()
+        self.run = run = self.train.board(self, self.engine.time(), self.config["priority"], cpu, memory)
+        try:
+            tracing.annotate(group=self.train.name)
+            with tracing.span("boarding"):
+                await self.engine.sleep(max(0, run.departsAt - self.engine.time()))
+            if self.train.close(run, self.kube.namespace):
+                riders = ", ".join(r.baseDeploymentName for r in run.riders)
+                self.log(f"Rolling out group {self.train.name} with {riders}")
+            self.ticket = run.ticket
+            if run.ticket is not None:
+                with tracing.span("queued"):
+                    while not await self.scheduler.admit(run.ticket, STOP_POLL):
+                        if self.stopped:
+                            return
+                        if self.abort:
+                            break
+            await self.deployCanary(resume)
+        finally:
+            self.train.leave(run, self)
+            self.run = None
+            self.ticket = None
+
+    async def align(self, phase):
+        # waits until every rider of the release train reached phase, see ReleaseTrain.align.
+        # Phases are counted twice a step: before the canaries of the step are added, and before its checks
+        self.train.reach(self.run, self, phase)
+        with tracing.span("aligning", phase=phase):
+            while not await self.train.align(self.run, phase, STOP_POLL):
+                if self.stopped or self.abort:
+                    break
 
-    def deployCanary(self, baseDeployment):
+    async def check(self, tick):
+        # checkCanarySuccess, for every rider of the release train at once when there is one.
+        # The first rider asking evaluates it, the others wait for its result
+        if self.run is None:
+            return await self.checkCanarySuccess()
+        if self.train.claim(self.run, tick):
+            success = False
+            try:
+                success = await self.checkCanarySuccess(self.train.checking(self.run))
+            finally:
+                self.train.settle(self.run, tick, success)
+            return success
+        success = None
+        while success is None and not self.stopped and self.run.failed is None:
+            success = await self.train.result(self.run, tick, STOP_POLL)
+        return bool(success)
+
+    def halted(self):
+        # true once stopped, a canary pod failed, or another rider of the release train failed.
+        # Evaluated with locks held, only reads attributes
+        return self.stopped or self.fault is not None or (self.run is not None and self.run.failed is not None)
+
+    def halt(self):
+        # wakes up the waits of deployCanary, to see it is halted
+        with self.alarm.cond:
+            self.alarm.notify()
+        self.kube.wake(self.canaryName)
+        self.kube.wake(self.primaryName)
+        run = self.run
+        if run is not None:
+            self.train.wake(run)
+
+    async def stepRequests(self):
+        # CPU and memory requested by the canary pods of a step, on top of those of the primary.
+        # Only read when the rollout scheduler has a budget, requests it can't parse count as 0
+        scheduler = self.scheduler or (self.train and self.train.scheduler)
+        if scheduler is None or (scheduler.cpuBudget is None and scheduler.memoryBudget is None):
+            return 0, 0
+        deployment = await self.kube.getCachedDeploy(self.baseDeploymentName)
+        cpu = memory = 0
+        for container in deployment.spec.template.spec.containers:
+            requests = (container.resources and container.resources.requests) or {}
+            try:
+                cpu += parseQuantity(requests.get("cpu", 0))
+                memory += parseQuantity(requests.get("memory", 0))
+            except ValueError as e:
+                self.warn(f"Ignoring the requests of container {container.name} in the rollout budget: {e}")
+        step = math.ceil(self.replicas * self.config["step"])
+        return cpu * step, memory * step
+
+    async def deployCanary(self, resume=None):
+        # the rollout stops as soon as a canary pod fails, instead of at its next check
+        self.fault = None
+        unwatch = self.kube.watchPodFaults(self.canaryName, self.onPodFault)
+        try:
+            await self._deployCanary(resume)
+        finally:
+            unwatch()
+
+    def onPodFault(self, pod, fault):
+        # called by the pod informer with its lock held, must be quick
+        if self.fault is None:
+            self.fault = f"{pod} {fault}"
+            with self.alarm.cond:
+                self.alarm.notify()
+
+    async def pause(self, seconds, phase):
+        # sleeps for seconds, or until halted
+        with tracing.span(phase, seconds=seconds):
+            await self.engine.adapt(self.alarm).wait(self.halted, seconds)
+
+    async def _deployCanary(self, resume=None):
         self.deploying = True
         # handle a canary deployment
         # canaries are scaled up progressively, following the "step" parameter in the configuration
         # final promotion of the canary deployment is performed if the "breakpoint" volume of instance is reached
         # and if every metric listed under "success" returns something
-        baseDeployment = copy.deepcopy(baseDeployment)
-        self.kube.scaleDeploy(self.baseDeploymentName, 0)
-        self.log("Rolling out canary deployment")
-
-        # get canary object and update spec to latest base deployment
-        canary = self.kube.getDeploy(self.canaryName)
-        canary.spec = baseDeployment.spec
-        self.kube.deploy(self.prepareDeploy(canary))
-
+        # resume is the checkpoint of a rollout interrupted by a restart, it goes on from where it stopped
+        baseDeployment = await self.kube.getDeploy(self.baseDeploymentName)
         maxInstances = math.ceil(self.replicas * self.config["breakpoint"])
-        stepInstances = math.ceil(self.replicas * self.config["step"])
-        canaryInstances = stepInstances
+        baseStep = math.ceil(self.replicas * self.config["step"])
+        # what checkpoint saves, stepStart, failures and streak are only set while checks run.
+        # It is saved when a step starts, on failed checks and when the step ends, not on every healthy check:
+        # a resumed rollout counts its healthy checks from 0 again, and a step resumed during its checks
+        # checks for max_step_duration again, however long the restart took
+        annotations = self.rolloutAnnotations()
+        if resume is not None:
+            resume = dict(resume, healthy=0)
+            if "stepStart" in resume:
+                resume.update(stepStart=self.engine.time(), streak=0)
+        state = resume or {
+            "rollout": annotations["aviary-id"],
+            "spec": self.classifier.fingerprint(self.kube.toDict(baseDeployment)).canary,
+            "replicas": self.replicas,
+            "canary": baseStep,  # canary instances of the current step
+            "step": baseStep,  # instances added by the current step
+            "healthy": 0,  # consecutive healthy checks of the whole rollout, for early promotion
+        }
+
+        tracing.annotate(rollout=state["rollout"], resumed=resume is not None)
+
+        if resume is None:
+            with tracing.span("prepare"):
+                await self.kube.scaleDeploy(self.baseDeploymentName, 0)
+                self.log("Rolling out canary deployment")
+
+                # update canary spec to latest base deployment, canary instances are added step by step
+                spec = copy.copy(baseDeployment.spec)
+                spec.replicas = 0
+                annotations[CHECKPOINT] = self.encodeCheckpoint(state)
+                await self.kube.applySpec(self.canaryName, spec, annotations)
+            self.progress = dict(state)
+        else:
+            self.log(f"Resuming canary deployment at {state['canary']} instances")
+
+        stepInstances = state["step"]
+        canaryInstances = state["canary"]
+        healthy = state["healthy"]
+        growthAfter = self.config["step_growth_after"]
         failed = False
-        ts_start = time.time()
+        promoted = False
+        ts_start = self.engine.time()
         self.log(f"Breakpoint set at {maxInstances} instances, going by increments of {stepInstances}")
-        expected_deploy_time = math.ceil(maxInstances / stepInstances) * (
-            self.config["start_delay"] + self.config["max_step_duration"]
-        )
-        expected_deploy_time = str(datetime.timedelta(seconds=expected_deploy_time))
-
-        self.log(f"Expected deployment time is around {expected_deploy_time}s")
-
-        while canaryInstances <= maxInstances and not failed and not self.abort:
-            self.log(f"Deploying {stepInstances} instance ... ({canaryInstances}/{self.replicas-canaryInstances})")
-            self.kube.scaleDeploy(self.canaryName, canaryInstances)
-            if not self.kube.waitDeploymentReady(self.canaryName, self.config["abort"]):
-                failed = True
-                break
-            self.kube.scaleDeploy(self.primaryName, self.replicas - canaryInstances)
-            self.kube.waitDeploymentReady(self.primaryName)
-            self.log("done")
-            canaryInstances += stepInstances
-
-            time.sleep(self.config["start_delay"])
-
-            ts_start = time.time()
-            failures = 0
-            while time.time() - ts_start < self.config["max_step_duration"]:
-                if self.abort:
+        self.logExpectedDeployTime(maxInstances, baseStep)
+
+        metrics.ROLLOUT_ACTIVE.labels(self.baseDeploymentName).set(1)
+        steps = 0
+        while canaryInstances <= maxInstances and not failed and not self.abort and not self.stopped:
+            with tracing.span("step", canary=canaryInstances, step=stepInstances):
+                steps += 1
+                if self.run is not None:
+                    await self.align(2 * steps - 1)
+                    if self.abort or self.stopped:
+                        break
+                if self.stopped:
                     break
-                if not self.checkCanarySuccess():
-                    failures += 1
-                    if failures >= self.config["check_max_failures"]:
+                if self.halted():
+                    failed = True
+                    break
+                calls = self.kube.countCalls()
+                stepBegin = self.engine.time()
+                metrics.CANARY_INSTANCES.labels(self.baseDeploymentName).set(canaryInstances)
+                metrics.ROLLOUT_PROGRESS.labels(self.baseDeploymentName).set(canaryInstances / max(maxInstances, 1))
+                if "stepStart" not in state:  # a step resumed after its canaries were up only runs the checks left
+                    self.log(
+                        f"Deploying {stepInstances} instance ... ({canaryInstances}/{self.replicas-canaryInstances})"
+                    )
+                    await self.kube.scaleDeploy(self.canaryName, canaryInstances)
+                    with tracing.span("canary ready"):
+                        ready = await self.kube.waitDeploymentReady(self.canaryName, self.config["abort"], self.halted)
+                    if self.stopped:
+                        break
+                    if not ready:
                         failed = True
                         break
-                time.sleep(self.config["check_success_step_duration"])
+                    await self.kube.scaleDeploy(self.primaryName, self.replicas - canaryInstances)
+                    with tracing.span("primary ready"):
+                        await self.kube.waitDeploymentReady(self.primaryName, 60, self.halted)
+                    self.log("done")
+
+                    await self.pause(self.config["start_delay"], "start delay")
+                    if self.stopped:
+                        break
+                    state.update(stepStart=self.engine.time(), failures=0, streak=0)
+                    await self.checkpoint(state)
+
+                if self.run is not None:
+                    await self.align(2 * steps)
+                ts_start = state["stepStart"]
+                failures = state["failures"]
+                streak = state["streak"]  # consecutive healthy checks of this step
+                checks = 0
+                while self.engine.time() - ts_start < self.config["max_step_duration"]:
+                    if self.abort or self.stopped:
+                        break
+                    if self.halted():
+                        failed = True
+                        break
+                    checks += 1
+                    with tracing.span("check"):
+                        success = await self.check((steps, checks))
+                        tracing.annotate(success=success)
+                    metrics.CHECKS.labels(self.baseDeploymentName, "success" if success else "failure").inc()
+                    if not success:
+                        failures += 1
+                        streak = healthy = 0
+                        stepInstances = baseStep
+                        if failures >= self.config["check_max_failures"]:
+                            failed = True
+                            break
+                        state.update(step=stepInstances, healthy=healthy, failures=failures, streak=streak)
+                        await self.checkpoint(state)
+                    else:
+                        streak += 1
+                        healthy += 1
+                        if self.isEarlyPromotion(healthy):
+                            promoted = True
+                            break
+                        if growthAfter and streak >= growthAfter:
+                            stepInstances = math.ceil(stepInstances * self.config["step_growth"])
+                            self.log(f"{streak} healthy checks in a row, next step is {stepInstances} instances")
+                            break
+                    # healthy checks are only shown by the admin console, they aren't saved
+                    self.progress = dict(state, healthy=healthy, streak=streak)
+                    await self.pause(self.config["check_success_step_duration"], "check interval")
+                self.log(f"Step made {sum(calls.values())} API calls {dict(calls)}")
+                metrics.STEPS.labels(self.baseDeploymentName).observe(self.engine.time() - stepBegin)
+                if promoted:
+                    self.log(f"{healthy} healthy checks in a row, promoting before the breakpoint")
+                    break
+                if failed:  # rolled back, no next step to save
+                    break
+                canaryInstances = self.nextStep(canaryInstances, stepInstances, maxInstances)
+                state = dict(state, canary=canaryInstances, step=stepInstances, healthy=healthy)
+                for key in ("stepStart", "failures", "streak"):
+                    del state[key]
+                if canaryInstances <= maxInstances and not self.abort and not self.stopped:
+                    await self.checkpoint(state)
+
+        if self.run is not None and not failed and not self.abort and not self.stopped:
+            # the group is promoted once every rider reached its breakpoint
+            self.train.finish(self.run, self)
+            with tracing.span("train"):
+                while not await self.train.finished(self.run, STOP_POLL):
+                    if self.stopped or self.abort:
+                        break
+            failed = self.run.failed is not None
+
+        metrics.ROLLOUT_ACTIVE.labels(self.baseDeploymentName).set(0)
+        metrics.CANARY_INSTANCES.labels(self.baseDeploymentName).set(0)
+        metrics.ROLLOUT_PROGRESS.labels(self.baseDeploymentName).set(0)
+        # why the release train rolls back, when another rider failed first
+        trainFailure = self.run is not None and self.run.failed
+        if self.run is not None and not self.stopped and (failed or self.abort):
+            if self.abort:
+                self.failTrain("was aborted")
+            else:
+                self.failTrain(f"has a failing pod, {self.fault}" if self.fault is not None else "failed its checks")
+        if self.stopped:
+            # the rollout is left as it is, the next owner resumes it from its checkpoint
+            self.log("Stopped during a canary deployment, leaving it to the next owner of the service")
+            return
 
         if self.abort:
             self.log(f"Canary deployment was aborted via admin console")
+            self.recordDecision("aborted")
             self.abort = False
-            self.rollbackCanary()
+            await self.rollbackCanary()
             return
 
+        if failed and self.fault is not None:
+            self.warn(f"Canary pod failing: {self.fault}")
+            metrics.CANARY_FAULTS.labels(self.baseDeploymentName).inc()
+        elif failed and trainFailure:
+            self.warn(f"Rolling back with group {self.train.name}, {trainFailure}")
         if failed:
-            self.log(f"Canary deployment failed after {round(time.time() - ts_start)}s, aborting deploy")
-            self.rollbackCanary()
+            self.log(f"Canary deployment failed after {round(self.engine.time() - ts_start)}s, aborting deploy")
+            self.recordDecision("rolled back")
+            await self.rollbackCanary()
             return
 
         self.log("Reached breakpoint, canaries were successful. Deploying new primaries ...")
-        baseDeployment.metadata.name = self.primaryName
-        self.deployDirect(baseDeployment)
-        self.kube.scaleDeploy(self.canaryName, 0)
-        self.kube.waitDeploymentReady(self.primaryName)
-        self.originalBaseDeployment = self.kube.getDeploy(self.baseDeploymentName)
+        self.recordDecision("promoted")
+        with tracing.span("promote"):
+            baseDeployment.metadata.name = self.primaryName
+            await self.deployDirect(baseDeployment)
+            await self.kube.scaleDeploy(self.canaryName, 0)
+            await self.checkpoint(None)
+            await self.kube.waitDeploymentReady(self.primaryName)
+        self.rememberBase(await self.kube.getDeploy(self.baseDeploymentName))
         self.log("done. Safe to exit.")
 
-    def checkCanarySuccess(self):
+    def failTrain(self, reason):
+        # rolls back every rider of the release train, the first failing rider wakes up the others
+        for rider in self.train.fail(self.run, self, reason):
+            rider.halt()
+
+    async def checkpoint(self, state):
+        # saves the state of the rollout in progress on the canary deployment, None once it is over.
+        # Once stopped, the next owner of the service resumes from the last one saved, nothing is written
+        if self.stopped:
+            return
+        await self.kube.annotate(self.canaryName, {CHECKPOINT: self.encodeCheckpoint(state)})
+        self.progress = None if state is None else dict(state)
+
+    def encodeCheckpoint(self, state):
+        return None if state is None else json.dumps(state, separators=(",", ":"))
+
+    def readCheckpoint(self, canary, base):
+        # checkpoint of the rollout in progress, None if there is none or if the base deployment
+        # doesn't contain the spec it was rolling out anymore
+        annotations = canary.metadata.annotations or {}
+        if CHECKPOINT not in annotations:
+            return None
+        try:
+            checkpoint = json.loads(annotations[CHECKPOINT])
+        except ValueError:
+            self.warn(f"Ignoring malformed checkpoint {annotations[CHECKPOINT]}")
+            return None
+        if checkpoint.get("spec") != self.classifier.fingerprint(self.kube.toDict(base)).canary:
+            self.log("The deployment changed since its canary rollout was interrupted, not resuming it")
+            return None
+        checkpoint.setdefault("rollout", annotations.get("aviary-id"))  # saved by earlier versions without it
+        return checkpoint
+
+    def nextStep(self, canaryInstances, stepInstances, maxInstances):
+        # canary instances of the step after canaryInstances. Growing steps stop at the breakpoint
+        # instead of jumping over it
+        nextInstances = canaryInstances + stepInstances
+        if self.config["step_growth_after"] and canaryInstances < maxInstances < nextInstances:
+            return maxInstances
+        return nextInstances
+
+    def isEarlyPromotion(self, healthy):
+        # after n healthy checks and no failure, the failure rate is under 3/n at a 95% confidence
+        rate = self.config["early_promotion"]
+        return rate > 0 and healthy >= 3 / rate
+
+    def logExpectedDeployTime(self, maxInstances, stepInstances):
+        # fixed steps last start_delay + max_step_duration. Growing steps are estimated when every check
+        # passes: they last until step_growth_after checks, or until early promotion
+        steps = math.ceil(maxInstances / stepInstances)
+        expected_deploy_time = str(
+            datetime.timedelta(seconds=steps * (self.config["start_delay"] + self.config["max_step_duration"]))
+        )
+        if not self.config["step_growth_after"] and not self.config["early_promotion"]:
+            self.log(f"Expected deployment time is around {expected_deploy_time}s")
+            return
+
+        checks = self.config["step_growth_after"] or math.inf
+        promotion = math.ceil(3 / self.config["early_promotion"]) if self.config["early_promotion"] else math.inf
+        stepMaxChecks = math.floor(self.config["max_step_duration"] / self.config["check_success_step_duration"]) + 1
+        canaryInstances, seconds, healthy = stepInstances, 0, 0
+        while canaryInstances <= maxInstances:
+            stepChecks = min(checks, promotion - healthy, stepMaxChecks)
+            if stepChecks < stepMaxChecks:
+                seconds += self.config["start_delay"] + (stepChecks - 1) * self.config["check_success_step_duration"]
+            else:
+                seconds += self.config["start_delay"] + self.config["max_step_duration"]
+            healthy += stepChecks
+            if healthy >= promotion:
+                break
+            if self.config["step_growth_after"]:
+                stepInstances = math.ceil(stepInstances * self.config["step_growth"])
+            canaryInstances = self.nextStep(canaryInstances, stepInstances, maxInstances)
+        adaptive_deploy_time = str(datetime.timedelta(seconds=round(seconds)))
+        self.log(
+            f"Expected deployment time is around {adaptive_deploy_time}s if every check passes, "
+            f"{expected_deploy_time}s at most"
+        )
+
+    async def checkCanarySuccess(self, riders=None):
         # checks if canaries instances are successful
-        # successful means no restarts, and values returned from all PromQL expressions under "success"
-        if self.kube.restarted(self.canaryName):
-            self.log("Saw restarts on canary instances")
+        # successful means no failing pod, see onPodFault, and values returned from all PromQL expressions
+        # under "success"
+        # each expression is sent once for all the canary pods when it can be rewritten to match them all,
+        # otherwise once per pod, concurrently
+        # expressions with a "compare" aggregate must rather not be worse on canaries than on primaries
+        # riders are the services of a release train checked at once, see ReleaseTrain. An expression reading
+        # the same for several of them, once its placeholders other than <<pod>> are filled, is sent once
+        for c in riders or [self]:
+            if c.fault is not None:
+                c.log(f"Canary pod failing: {c.fault}")
+                return False
+        failed = {}  # pod -> first query that returned nothing for it
+        owners = {}  # pod -> BirdWatcher of its service
+        batches = {}  # bound expression -> [(template, canaryPods, context)] sent as one query
+        perPod = []  # (pod, query) left to send one by one
+        for c in riders or [self]:
+            canaryPods = await c.kube.getPodsList(c.canaryName)
+            owners.update((pod, c) for pod in canaryPods)
+            # what the placeholders of the expressions stand for, besides <<pod>>, see promql.QueryTemplate
+            context = (await c.kube.getPodsList(c.primaryName), c.baseDeploymentName, c.kube.namespace)
+            for expr in c.config["success"]:
+                template = expr["template"]
+                if "compare" in expr:
+                    try:
+                        if not await c.compareToPrimary(expr, canaryPods, context, failed):
+                            return False
+                    except PrometheusError as e:
+                        c.warn(e)
+                        return False
+                elif template.batchable and canaryPods:
+                    batches.setdefault(template.bind(*context), []).append((template, canaryPods, context))
+                else:
+                    perPod += template.perPod(canaryPods, *context)
+
+        for bound, members in batches.items():
+            if len(members) == 1:
+                template, canaryPods, context = members[0]
+                query, label = template.batch(canaryPods, *context)
+            else:
+                query, label = promql.batchQuery(bound, [pod for _, pods, _ in members for pod in pods])
+            try:
+                result = await self.prom.getVector(query)
+            except PrometheusError as e:
+                self.warn(e)
+                return False
+            for template, canaryPods, context in members:
+                if result and all(label in sample["metric"] for sample in result):
+                    seen = {sample["metric"][label] for sample in result}
+                    for pod in canaryPods:
+                        if pod not in seen:
+                            failed.setdefault(pod, template.forPod(pod, *context))
+                else:
+                    # nothing came back, or the pod label was aggregated away: each pod is asked on its own
+                    # rather than failing pods whose own values may pass
+                    perPod += template.perPod(canaryPods, *context)
+
+        try:
+            values = await self.prom.getLastValues([query for _, query in perPod])
+        except PrometheusError as e:
+            self.warn(e)
+            return False
+        for (pod, query), value in zip(perPod, values):
+            if value is None:
+                failed.setdefault(pod, query)
+
+        for pod, query in failed.items():
+            owners.get(pod, self).log(query, ":", None)
+        return not failed
+
+    async def compareToPrimary(self, expr, canaryPods, context, failed):
+        # one range query for canary and primary pods, the canary must not be worse than the primary
+        # beyond the tolerance of the expression. Canary pods without samples are added to failed
+        template = expr["template"]
+        primaryPods = context[0]
+        query, label = template.batch(canaryPods + primaryPods, *context)
+        result = await self.prom.getRange(query, expr["window"], expr["resolution"])
+        if not all(label in series["metric"] for series in result):
+            self.warn(f"{expr['expr']}: the pod label was aggregated away, canary and primary can't be compared")
             return False
-        canaryPods = self.kube.getPodsList(self.canaryName)
+        canary, primary, seen = analysis.splitSamples(result, label, set(canaryPods))
         for pod in canaryPods:
-            for expr in self.config["success"]:
-                queryWithPodName = expr["expr"].replace("<<pod>>", pod)
-                value = self.prom.getLastValue(queryWithPodName)
-                if value is None:
-                    self.log(queryWithPodName, ":", value)
-                    return False
-        return True
-
-    def rollbackCanary(self):
-        # scale primary deploy to base number of replicas and scale down canary
-        self.kube.scaleDeploy(self.primaryName, self.replicas)
-        self.kube.scaleDeploy(self.canaryName, 0)
-        self.kube.waitDeploymentReady(self.primaryName)
-        self.rollbackBaseDeployment()
+            if pod not in seen:
+                failed.setdefault(pod, template.forPod(pod, *context))
+        success, reason = analysis.compare(expr, canary, primary)
+        if not success:
+            self.log(expr["expr"], ":", reason)
+        return success
+
+    async def rollbackCanary(self):
+        # scale primary deploy to base number of replicas and scale down canary.
+        # The checkpoint goes first, a restart in between must not resume the rejected rollout
+        with tracing.span("rollback"):
+            await self.checkpoint(None)
+            await self.kube.scaleDeploy(self.primaryName, self.replicas)
+            await self.kube.scaleDeploy(self.canaryName, 0)
+            await self.kube.waitDeploymentReady(self.primaryName)
+            await self.rollbackBaseDeployment()
         self.log("rollback done. Safe to exit.")
 
-    def rollbackBaseDeployment(self):
+    async def rollbackBaseDeployment(self):
         self.log("Rolling back base deployment from primary deployment")
-        base = self.kube.getDeploy(self.baseDeploymentName)
-        primary = self.kube.getDeploy(self.primaryName)
-        base.spec = primary.spec
-        base.spec.replicas = 0
+        primary = await self.kube.getDeploy(self.primaryName)
+        spec = primary.spec
+        spec.replicas = 0
         # retrieve current primary replicas and rollback modifications to base deployment
         # this will allow to reapply modifications later
-        self.kube.deploy(base)
-        self.originalBaseDeployment = self.kube.getDeploy(self.baseDeploymentName)
+        await self.kube.applySpec(self.baseDeploymentName, spec)
+        self.rememberBase(await self.kube.getDeploy(self.baseDeploymentName))
@@ -0,0 +1,88 @@
+# std
+import collections
+import fnmatch
+import hashlib
+import json
+import re
+
+# Paths are dotted fields of the deployment as written in its YAML, list items are [i],
+# e.g. spec.template.spec.containers[0].image. They support glob matching.
+DEFAULT_CANARY_PATHS = [
+    "spec.template.spec.containers*",
+    "spec.template.spec.initContainers*",
+]
+DEFAULT_IGNORE_PATHS = [
+    "metadata.resourceVersion",
+    "metadata.generation",
+    "metadata.managedFields*",
+    "metadata.annotations.deployment.*",
+    "metadata.annotations.kubectl.kubernetes.io/last-applied-configuration",
+    "status*",
+]
+SCALE_PATH = "spec.replicas"
+
+# digests of the parts of a deployment that drive the decision of shouldDeploy:
+# canary: every field under a canary path, other: every field neither canary nor ignored.
+# images are kept as they are, for logs
+Fingerprint = collections.namedtuple("Fingerprint", ["canary", "other", "replicas", "images"])
+
+
+def _compile(paths):
+    # one regex for a list of globs. Brackets are list indexes, not character classes
+    return re.compile("|".join(fnmatch.translate(p).replace("[", "\\[").replace("]", "\\]") for p in paths))
+
+
+def _prefix(path):
+    # literal part of a glob, before its first wildcard
+    return re.split(r"[*?]", path, maxsplit=1)[0]
+
+
+class ChangeClassifier:
+    # Decides how a change to a deployment is rolled out, by comparing fingerprints
+    # of the deployment instead of diffing the whole objects.
+    def __init__(self, canaryPaths=None, ignorePaths=None):
+        canaryPaths = canaryPaths or DEFAULT_CANARY_PATHS
+        ignorePaths = DEFAULT_IGNORE_PATHS + (ignorePaths or [])
+        self.canaryRE = _compile(canaryPaths)
+        self.ignoreRE = _compile(ignorePaths)
+        # literal prefixes of every path we look for: a subtree outside of them is hashed at once
+        self.prefixes = [_prefix(p) for p in canaryPaths + ignorePaths] + [SCALE_PATH]
+
+    def fingerprint(self, deployment):
+        # deployment is the serialized form of a V1Deployment, see KubernetesInterface.toDict
+        canary = hashlib.blake2b(digest_size=16)
+        other = hashlib.blake2b(digest_size=16)
+        self._walk(deployment, "", canary, other)
+        spec = deployment.get("spec", {})
+        podSpec = spec.get("template", {}).get("spec", {})
+        images = tuple(c.get("image") for c in podSpec.get("initContainers", []) + podSpec.get("containers", []))
+        return Fingerprint(canary.hexdigest(), other.hexdigest(), spec.get("replicas"), images)
+
+    def classify(self, old, new):
+        # "canary", "direct", "scale", or "" when the change doesn't need to be deployed
+        if old.canary != new.canary:
+            return "canary"
+        if old.other != new.other:
+            return "direct"
+        if old.replicas != new.replicas and new.replicas != 0:  # og deployment was scaled manually
+            return "scale"
+        return ""  # nothing changed, or og deployment was rescaled to 0 by aviary
+
+    def _walk(self, node, path, canary, other):
+        if path == SCALE_PATH or self.ignoreRE.match(path):
+            return
+        if self.canaryRE.match(path):
+            canary.update(f"{path}={json.dumps(node, sort_keys=True)};".encode())
+            return
+        if not isinstance(node, (dict, list)) or not self._mayContainPaths(path):
+            other.update(f"{path}={json.dumps(node, sort_keys=True)};".encode())
+            return
+        if isinstance(node, dict):
+            for key in sorted(node):
+                self._walk(node[key], f"{path}.{key}" if path else key, canary, other)
+        else:
+            for i, item in enumerate(node):
+                self._walk(item, f"{path}[{i}]", canary, other)
+
+    def _mayContainPaths(self, path):
+        return any(prefix.startswith(path) or path.startswith(prefix) for prefix in self.prefixes)
@@ -0,0 +1,58 @@
+# deps
+import yaml
+
+# std
+import os
+import threading
+import time
+
+# sekoia
+import eventlog
+
+
+def loadConfig(path):
+    with open(path) as f:
+        return yaml.load(f.read(), Loader=yaml.SafeLoader)
+
+
+class ConfigWatcher:
+    # Calls onChange with the content of canaries.yaml every time it changes.
+    # The file is stat'ed every interval seconds, and read again when its mtime, inode or size moves.
+    # ConfigMap volumes are updated by swapping a symlink, which os.stat follows.
+    def __init__(self, path, onChange, interval=10):
+        self.path = path
+        self.onChange = onChange
+        self.interval = interval
+        self.stat = self._stat()
+        with open(path) as f:
+            self.content = f.read()
+        self.thread = threading.Thread(target=self.run, name="config-watcher", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as e:
+                eventlog.warn("ConfigWatcher", f"Couldn't reload {self.path}: {e}")
+
+    def check(self):
+        stat = self._stat()
+        if stat == self.stat:
+            return
+        self.stat = stat
+        with open(self.path) as f:
+            content = f.read()
+        if content == self.content:
+            return
+        self.content = content
+        eventlog.log("ConfigWatcher", f"{self.path} changed, reloading")
+        self.onChange(yaml.load(content, Loader=yaml.SafeLoader))
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_ino, stat.st_size
@@ -0,0 +1,138 @@
+# std
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# BirdWatchers are written as coroutines awaiting their clients, the engine decides how they run:
+# - "threads": one OS thread per watcher, client calls block that thread (the historical mode)
+# - "asyncio": every watcher is a task of one event loop, client calls go to a small thread pool
+# Clients (KubernetesInterface, PrometheusClient) stay plain blocking classes, engines wrap them
+# with adapt(). A client method named <name>Async is used instead of <name> by the asyncio engine.
+
+
+def nonblocking(method):
+    # marks a client method cheap enough to be called directly, without await, by every engine
+    method.nonblocking = True
+    return method
+
+
+def runSync(coro):
+    # drives to completion a coroutine that never suspends, as every coroutine of the threads engine
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError("a coroutine suspended on the threads engine, it must only await engine calls")
+
+
+class ThreadEngine:
+    name = "threads"
+
+    def __init__(self, poolSize=None):
+        self.threads = []
+
+    def adapt(self, client):
+        return _Adapter(client, self._call)
+
+    async def _call(self, method, *args, **kwargs):
+        return method(*args, **kwargs)
+
+    async def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def time(self):
+        return time.time()
+
+    def run(self, coro):
+        # runs a coroutine from the outside and returns its result
+        return runSync(coro)
+
+    def spawn(self, coro, name=None):
+        # runs a coroutine in the background
+        thread = threading.Thread(target=runSync, args=(coro,), name=name)
+        thread.start()
+        self.threads += [thread]
+
+    def gather(self, coros, limit):
+        # runs coroutines side by side, at most limit at once, and returns their results in order
+        with ThreadPoolExecutor(max_workers=limit) as pool:
+            return list(pool.map(runSync, coros))
+
+    def wait(self):
+        for t in self.threads:
+            t.join()
+
+
+class AsyncioEngine:
+    name = "asyncio"
+
+    def __init__(self, poolSize=16):
+        self.pool = ThreadPoolExecutor(max_workers=poolSize)  # runs the blocking client calls
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="asyncio-engine", daemon=True)
+        self.thread.start()
+        self.tasks = []
+
+    def adapt(self, client):
+        return _Adapter(client, self._call, suffix="Async")
+
+    async def _call(self, method, *args, **kwargs):
+        # the context is carried to the pool thread, for per task counters like KubernetesInterface.countCalls
+        context = contextvars.copy_context()
+        return await self.loop.run_in_executor(self.pool, functools.partial(context.run, method, *args, **kwargs))
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    def time(self):
+        return time.time()
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def spawn(self, coro, name=None):
+        self.tasks += [asyncio.run_coroutine_threadsafe(coro, self.loop)]
+
+    def gather(self, coros, limit):
+        async def gather():
+            semaphore = asyncio.Semaphore(limit)
+
+            async def limited(coro):
+                async with semaphore:
+                    return await coro
+
+            return await asyncio.gather(*(limited(coro) for coro in coros))
+
+        return self.run(gather())
+
+    def wait(self):
+        for t in self.tasks:
+            t.result()
+
+
+ENGINES = {e.name: e for e in (ThreadEngine, AsyncioEngine)}
+
+
+class _Adapter:
+    # exposes every method of a client as a coroutine running it through the engine.
+    # Attributes and nonblocking methods are returned as they are.
+    def __init__(self, client, call, suffix=None):
+        self.client = client
+        self._call = call
+        self._suffix = suffix
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr) or getattr(attr, "nonblocking", False):
+            return attr
+        if self._suffix and hasattr(self.client, name + self._suffix):
+            return getattr(self.client, name + self._suffix)
+
+        async def call(*args, **kwargs):
+            return await self._call(attr, *args, **kwargs)
+
+        return call
@@ -0,0 +1,103 @@
+# std
+import atexit
+import datetime
+import json
+import queue
+import sys
+import threading
+
+# Log of aviary, one JSON object per line:
+#   {"time": "...", "level": "info", "source": "my-service", "message": "...", "rollout": "...", ...}
+# Records are put in a queue and written by a thread of their own, so that callers never wait on
+# stdout and lines of several threads never interleave. When the queue is full, because stdout
+# can't keep up, records are dropped and the next written record says how many.
+
+QUEUE_SIZE = 100000  # records waiting to be written
+BATCH = 1000  # records written at once
+
+
+class EventLog:
+    def __init__(self, stream=None, size=QUEUE_SIZE):
+        self.stream = stream  # None for sys.stdout, looked up on every write
+        self.queue = queue.Queue(size)
+        self.dropped = 0  # records lost since the last write
+        self.thread = threading.Thread(target=self.run, name="event-log", daemon=True)
+        self.thread.start()
+
+    def emit(self, level, source, message, **fields):
+        # queues a record and returns it. Fields set to None are left out
+        record = {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": level,
+            "source": source,
+            "message": message,
+        }
+        record.update((key, value) for key, value in fields.items() if value is not None)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        return record
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            while len(records) < BATCH:
+                try:
+                    records += [self.queue.get_nowait()]
+                except queue.Empty:
+                    break
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                records[0] = dict(records[0], dropped=dropped)
+            stream = self.stream or sys.stdout
+            try:
+                stream.write("".join(json.dumps(record, default=str) + "\n" for record in records))
+                stream.flush()
+            except Exception:
+                pass  # a log that can't be written mustn't stop the next ones
+            for _ in records:
+                self.queue.task_done()
+
+    def flush(self):
+        # waits until every queued record is written
+        self.queue.join()
+
+
+_log = None
+_lock = threading.Lock()
+
+
+def configure(stream=None, size=QUEUE_SIZE):
+    # replaces the log, e.g. to write it elsewhere than on stdout
+    global _log
+    with _lock:
+        if _log is not None:
+            _log.flush()
+        _log = EventLog(stream, size)
+    return _log
+
+
+def get():
+    global _log
+    with _lock:
+        if _log is None:
+            _log = EventLog()
+        return _log
+
+
+def log(source, message, level="info", **fields):
+    # queues a record of source (a service, or a part of aviary like "Aviary" or "ShardManager")
+    return get().emit(level, source, message, **fields)
+
+
+def warn(source, message, **fields):
+    return log(source, message, level="warning", **fields)
+
+
+def flush():
+    if _log is not None:
+        _log.flush()
+
+
+atexit.register(flush)
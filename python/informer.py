@@ -0,0 +1,143 @@
+# std
+import threading
+import time
+
+# sekoia
+import eventlog
+import kubeclient
+import metrics
+from kubeclient import rest, watch
+from notifier import Notifier
+
+
+class Informer:
+    # Keeps a local cache of every object of one kind in a namespace.
+    # The cache is filled by one LIST, then kept up to date by a WATCH resumed
+    # from the last seen resourceVersion, so readers never hit the API server.
+    # Cached objects are shared between threads and must not be mutated.
+    # With subscribe, events are pushed to handle instead of being watched, see simulator.py
+    def __init__(self, listFunc, namespace, kind, subscribe=None):
+        self.listFunc = listFunc  # bound list_namespaced_* method of the API
+        self.subscribe = subscribe  # subscribe(namespace, kind, handle) registers for events
+        self.namespace = namespace
+        self.kind = kind
+        self.objects = {}  # object name -> last seen object
+        self.labelIndex = {}  # (label, value) -> names of the objects carrying it
+        self.resourceVersion = None  # resume point of the watch, None forces a new LIST
+        self.receivedAt = {}  # object name -> time.time() when its last change was received
+        self.notifier = Notifier()  # notified with the object name on every change
+        self.cond = self.notifier.cond
+        self.synced = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        if self.subscribe is not None:
+            self.relist()
+            self.subscribe(self.namespace, self.kind, self.handle)
+            return self
+        self.thread.start()
+        self.synced.wait()
+        return self
+
+    def run(self):
+        while True:
+            try:
+                if self.resourceVersion is None:
+                    self.relist()
+                self.watch()
+            except rest.ApiException as e:
+                if e.status == 410:  # our resourceVersion is too old, start again from a fresh LIST
+                    self.resourceVersion = None
+                    continue
+                eventlog.warn("Informer", f"watch of {self.kind} failed: {e}", namespace=self.namespace)
+                time.sleep(1)
+            except Exception as e:
+                eventlog.warn("Informer", f"watch of {self.kind} failed: {e}", namespace=self.namespace)
+                time.sleep(1)
+
+    def relist(self):
+        res = self.listFunc(namespace=self.namespace, _request_timeout=kubeclient.requestTimeout())
+        with self.cond:
+            self.objects = {}
+            self.labelIndex = {}
+            for obj in res.items:
+                self._store(obj)
+            self.receivedAt = {name: t for name, t in self.receivedAt.items() if name in self.objects}
+            self.resourceVersion = res.metadata.resource_version
+            self.notifier.notify()
+        self.synced.set()
+
+    def watch(self):
+        stream = watch.Watch().stream(
+            self.listFunc,
+            namespace=self.namespace,
+            resource_version=self.resourceVersion,
+            allow_watch_bookmarks=True,
+            timeout_seconds=300,
+            _request_timeout=kubeclient.requestTimeout() + 300,  # a connection gone silent is dropped
+        )
+        for event in stream:
+            if event["type"] == "ERROR":
+                raise rest.ApiException(
+                    status=event["raw_object"].get("code"), reason=event["raw_object"].get("message")
+                )
+            if event["type"] == "BOOKMARK":
+                self.resourceVersion = event["raw_object"]["metadata"]["resourceVersion"]
+                continue
+            self.handle(event)
+
+    def handle(self, event):
+        # applies an ADDED, MODIFIED or DELETED event to the cache
+        metrics.INFORMER_EVENTS.labels(self.namespace, self.kind, event["type"]).inc()
+        obj = event["object"]
+        with self.cond:
+            self._forget(obj.metadata.name)
+            if event["type"] != "DELETED":
+                self._store(obj)
+                self.receivedAt[obj.metadata.name] = time.time()
+            else:
+                self.receivedAt.pop(obj.metadata.name, None)
+            self.resourceVersion = obj.metadata.resource_version
+            self.notifier.notify(obj.metadata.name)
+
+    def _store(self, obj):
+        self.objects[obj.metadata.name] = obj
+        for label in (obj.metadata.labels or {}).items():
+            self.labelIndex.setdefault(label, set()).add(obj.metadata.name)
+
+    def _forget(self, name):
+        obj = self.objects.pop(name, None)
+        if obj is None:
+            return
+        for label in (obj.metadata.labels or {}).items():
+            names = self.labelIndex[label]
+            names.discard(name)
+            if not names:
+                del self.labelIndex[label]
+
+    def get(self, name):
+        with self.cond:
+            return self.objects.get(name)
+
+    def list(self):
+        with self.cond:
+            return list(self.objects.values())
+
+    def select(self, match_labels):
+        # objects carrying all the given labels, resolved through the label index
+        with self.cond:
+            if not match_labels:
+                return list(self.objects.values())
+            candidates = sorted((self.labelIndex.get(label, set()) for label in match_labels.items()), key=len)
+            names = set.intersection(*candidates)
+            return [self.objects[name] for name in names]
+
+    def wait(self, predicate, timeout=None, name=None):
+        # blocks until predicate() is true, re-evaluating it on every event.
+        # Returns False if it was still false after timeout seconds. With a name, only events on that object
+        # wake it up
+        return self.notifier.wait(predicate, timeout, key=name)
+
+    async def waitAsync(self, predicate, timeout=None, name=None):
+        # same as wait from a coroutine
+        return await self.notifier.waitAsync(predicate, timeout, key=name)
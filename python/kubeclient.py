@@ -0,0 +1,69 @@
+# std
+import importlib
+import threading
+
+# Access to the Kubernetes API shared by every part of aviary: one ApiClient, so one pool of keep-alive
+# connections and one thread pool, and one object per API group on top of it.
+# The kubernetes package imports every model of the API on its first import, which takes a good part
+# of the startup and tens of MB. It is imported on first use, through the lazy modules below, so that
+# the configuration is checked and the metrics server is up before it is needed.
+
+
+class LazyModule:
+    # a module imported on the first access to one of its attributes
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+client = LazyModule("kubernetes.client")
+rest = LazyModule("kubernetes.client.rest")  # rest.ApiException
+watch = LazyModule("kubernetes.watch")
+
+_lock = threading.Lock()
+_settings = {"poolSize": None, "timeout": 30}
+_apiClient = None
+_apis = {}  # name of an API class -> its instance on the shared ApiClient
+
+
+def configure(poolSize=None, timeout=30):
+    # poolSize connections are kept alive, one per thread sending requests at once is enough.
+    # None keeps the default of the kubernetes package. Must be called before the first request.
+    _settings.update(poolSize=poolSize, timeout=timeout)
+
+
+def requestTimeout():
+    # seconds to connect and to wait for each answer, given as _request_timeout to API calls
+    return _settings["timeout"]
+
+
+def apiClient():
+    # the shared ApiClient, configured in the cluster, or for minikube in local dev
+    global _apiClient
+    with _lock:
+        if _apiClient is None:
+            config = importlib.import_module("kubernetes.config")
+            try:
+                config.load_incluster_config()
+            except config.ConfigException:
+                config.load_kube_config(context="minikube")
+            # a copy of the configuration just loaded, by either version of the kubernetes package
+            configuration = getattr(client.Configuration, "get_default_copy", client.Configuration)()
+            if _settings["poolSize"] is not None:
+                configuration.connection_pool_maxsize = _settings["poolSize"]
+            _apiClient = client.ApiClient(configuration)
+        return _apiClient
+
+
+def api(name):
+    # the instance of an API class of kubernetes.client, e.g. "AppsV1Api", on the shared ApiClient
+    shared = apiClient()
+    with _lock:
+        if name not in _apis:
+            _apis[name] = getattr(client, name)(shared)
+        return _apis[name]
@@ -1,111 +1,387 @@
-# deps
-from kubernetes import client, config
-from kubernetes.client.rest import ApiException
-from kubernetes.config.config_exception import ConfigException
-
 # std
+import collections
+import contextvars
+import copy
+import threading
 import time
 
+# sekoia
+import eventlog
+import kubeclient
+import metrics
+import tracing
+from engine import nonblocking
+from informer import Informer
+from kubeclient import client, rest
+
+# name under which the fields written by aviary are tracked by the API server
+FIELD_MANAGER = "aviary"
+
+# per thread (or task) counter of API calls, see KubernetesInterface.countCalls
+_stepCalls = contextvars.ContextVar("stepCalls", default=None)
+
 
 class KubernetesInterface:
-    def __init__(self, namespace="default"):
-        # try to use in-cluster config, otherwise tries minikube for local dev
-        try:
-            config.load_incluster_config()
-        except ConfigException:
-            config.load_kube_config(context="minikube")
+    def __init__(self, namespace="default", writeMode="patch", conflictRetries=5, api=None):
+        # api stands for both AppsV1Api and CoreV1Api, to run against a fake cluster, see simulator.py.
+        # Otherwise requests go through the ApiClient shared by every namespace, see kubeclient
+        self.apps = api or kubeclient.api("AppsV1Api")
+        self.core = api or kubeclient.api("CoreV1Api")
         self.namespace = namespace
+        self.writeMode = writeMode  # "patch" sends JSON patches of the changed fields, "replace" whole objects
+        self.conflictRetries = conflictRetries  # attempts left to a write refused because of a concurrent one
+        self.calls = collections.Counter()  # API method name -> number of requests sent since startup
+        self.coalesced = 0  # reads answered by a request already in flight
+        self.inflight = {}  # pending reads, see _call
+        self.written = {}  # deployment name -> generation returned by our last write to it
+        self.lock = threading.Lock()
+        # turns models back into their API form, see toDict
+        self.serializer = client.ApiClient() if api is not None else kubeclient.apiClient()
+
+        # shared caches of the namespace, kept up to date by one watch per kind
+        subscribe = getattr(api, "subscribe", None)
+        self.deployments = Informer(self.apps.list_namespaced_deployment, namespace, "deployments", subscribe).start()
+        self.pods = Informer(self.core.list_namespaced_pod, namespace, "pods", subscribe).start()
 
     def getDeploy(self, deployment_name: str):
-        return client.AppsV1Api().read_namespaced_deployment(namespace=self.namespace, name=deployment_name)
+        return self._call(self.apps.read_namespaced_deployment, name=deployment_name)
+
+    def waitDeployChange(self, deployment_name: str, uid: str, generation: int, timeout=None):
+        # sleeps until the informer sees a newer spec of the deployment than the given generation,
+        # and returns it. The returned object is shared with the cache and must not be mutated.
+        if not self.deployments.wait(self._changed(deployment_name, uid, generation), timeout, name=deployment_name):
+            return None
+        return self.deployments.get(deployment_name)
+
+    async def waitDeployChangeAsync(self, deployment_name: str, uid: str, generation: int, timeout=None):
+        changed = self._changed(deployment_name, uid, generation)
+        if not await self.deployments.waitAsync(changed, timeout, name=deployment_name):
+            return None
+        return self.deployments.get(deployment_name)
+
+    def _changed(self, deployment_name: str, uid: str, generation: int):
+        # metadata.generation only moves forward on spec changes, so a cache still lagging behind
+        # our own writes is never mistaken for a change. A new uid means it was deleted and recreated.
+        def changed():
+            cached = self.deployments.get(deployment_name)
+            return cached is not None and (cached.metadata.uid != uid or cached.metadata.generation > generation)
+
+        return changed
+
+    def getCachedDeploy(self, deployment_name: str):
+        # same as getDeploy, served from the informer cache when it has the deployment, without copying it.
+        # The returned object may be shared with the cache and must not be mutated, getDeploy returns one to change
+        return self._cachedDeploy(deployment_name)
 
     def getReplicas(self, deployment_name: str):
-        return (
-            client.AppsV1Api().read_namespaced_deployment(namespace=self.namespace, name=deployment_name).spec.replicas
-        )
+        return self._cachedDeploy(deployment_name).spec.replicas
 
     def isDeployExists(self, deployment_name: str):
-        exist = False
-        try:
-            client.AppsV1Api().read_namespaced_deployment(namespace=self.namespace, name=deployment_name)
-            exist = True
-        except ApiException:
-            exist = False
-        return exist
+        return self.deployments.get(deployment_name) is not None
 
     def scaleDeploy(self, deployment_name: str, replicas: int):
         tmp = {"spec": {"replicas": replicas}}
-        return client.AppsV1Api().patch_namespaced_deployment(namespace=self.namespace, name=deployment_name, body=tmp)
-
-    def restarted(self, deployment_name: str):
-        # compute selector matching deployment
-        selector = self._getSelector(deployment_name)
-
-        # counting restart in init_containers and containers
-        restart = 0
-        for pod in client.CoreV1Api().list_namespaced_pod(namespace=self.namespace, label_selector=selector).items:
-            if not pod.metadata.name.startswith(deployment_name):
-                continue
-            for c in pod.status.container_statuses:
-                restart += c.restart_count
-            if pod.status.init_container_statuses:
-                for c in pod.status.init_container_statuses:
-                    restart += c.restart_count
-        return restart > 0
-
-    def waitDeploymentReady(self, deployment_name: str, maxWait=60):
-        # this function extract the status from the list of pods, and then compare
-        # count the pods not in the “Running” state.
-        def fun(pods):
-            return len(list(filter(lambda phase: phase != "Running", map(lambda pod: pod.status.phase, pods),)))
-
-        # wait for scale to be active
-        print(f"waiting for pod to be created of deployment {deployment_name}")
-        while len(self.getPodsList(deployment_name)) == 0:
-            time.sleep(1)
-
-        print(f"Waiting for pods of deployment {deployment_name} to run for {maxWait}s")
-        i = 0
-        while self._iterOnPods(fun, deployment_name) > 0:
-            time.sleep(1)
-            i += 1
-            if i > maxWait:
-                print("[KubernetesInterface] Gave up on waiting on {} after {}".format(deployment_name, maxWait))
+        return self._call(self.apps.patch_namespaced_deployment, name=deployment_name, body=tmp)
+
+    def annotate(self, deployment_name: str, annotations: dict):
+        # merges annotations into the deployment, those set to None are removed
+        tmp = {"metadata": {"annotations": annotations}}
+        return self._call(self.apps.patch_namespaced_deployment, name=deployment_name, body=tmp)
+
+    @nonblocking
+    def watchPodFaults(self, deployment_name: str, callback):
+        # calls callback(pod, fault) as soon as the pod informer sees a pod of the deployment failing,
+        # see podFault, and wakes up the waitDeploymentReady of the deployment. Returns a function to stop it.
+        # Pods failing already are reported right away.
+        prefix = deployment_name + "-"
+
+        def ours(name):
+            # pods of the deployment are named <deployment>-<pod template hash>-<suffix>
+            return name.startswith(prefix) and name[len(prefix) :].count("-") == 1
+
+        def listener(name):
+            # runs with the lock of the pod informer held, so does callback
+            names = [n for n in self.pods.objects if ours(n)] if name is None else [name]
+            pods = [self.pods.objects[n] for n in names if ours(n) and n in self.pods.objects]
+            faults = [(pod.metadata.name, podFault(pod)) for pod in pods if pod.metadata.deletion_timestamp is None]
+            faults = [(pod, fault) for pod, fault in faults if fault is not None]
+            for pod, fault in faults:
+                callback(pod, fault)
+            if faults:
+                self.wake(deployment_name)
+
+        self.pods.notifier.listen(None, listener)
+        with self.pods.cond:
+            listener(None)
+        return lambda: self.pods.notifier.unlisten(None, listener)
+
+    @nonblocking
+    def wake(self, deployment_name: str):
+        # wakes up the waits on the deployment, to evaluate their interrupt again
+        with self.deployments.cond:
+            self.deployments.notifier.notify(deployment_name)
+
+    def waitDeploymentReady(self, deployment_name: str, maxWait=60, interrupt=None):
+        # waits until the deployment is rolled out, as `kubectl rollout status` does.
+        # Returns True if it already was, the number of seconds waited, or False after maxWait seconds,
+        # when the deployment exceeded its progress deadline, or as soon as interrupt() is true.
+        # interrupt is evaluated on changes of the deployment, and must only read attributes
+        eventlog.log("KubernetesInterface", f"Waiting for deployment {deployment_name} to be rolled out for {maxWait}s")
+        start = time.monotonic()
+        self.deployments.wait(self._rolledOut(deployment_name, interrupt), maxWait, name=deployment_name)
+        return self._rolloutResult(deployment_name, maxWait, start, interrupt)
+
+    async def waitDeploymentReadyAsync(self, deployment_name: str, maxWait=60, interrupt=None):
+        eventlog.log("KubernetesInterface", f"Waiting for deployment {deployment_name} to be rolled out for {maxWait}s")
+        start = time.monotonic()
+        await self.deployments.waitAsync(self._rolledOut(deployment_name, interrupt), maxWait, name=deployment_name)
+        return self._rolloutResult(deployment_name, maxWait, start, interrupt)
+
+    def _rolledOut(self, deployment_name: str, interrupt):
+        def rolledOut():
+            return self._rolloutStatus(deployment_name) is not None or (interrupt is not None and interrupt())
+
+        return rolledOut
+
+    def _rolloutResult(self, deployment_name: str, maxWait, start, interrupt=None):
+        metrics.READINESS_WAITS.labels(deployment_name).observe(time.monotonic() - start)
+        if interrupt is not None and interrupt():
+            eventlog.warn("KubernetesInterface", f"Stopped waiting on {deployment_name}, interrupted")
+            return False
+        status = self._rolloutStatus(deployment_name)
+        if status is None:
+            eventlog.warn("KubernetesInterface", "Gave up on waiting on {} after {}".format(deployment_name, maxWait))
+            return False
+        if status is False:
+            eventlog.warn("KubernetesInterface", f"Deployment {deployment_name} exceeded its progress deadline")
+            return False
+        waited = round(time.monotonic() - start)
+        return True if waited == 0 else waited
+
+    def _rolloutStatus(self, deployment_name: str):
+        # True when every wanted replica runs the latest spec and is available, with no old replica left,
+        # False if the deployment controller gave up on it, None while the rollout is in progress.
+        # The status is read from the informer cache, updated as soon as pods become (un)available.
+        deployment = self.deployments.get(deployment_name)
+        if deployment is None or deployment.metadata.generation < self.written.get(deployment_name, 0):
+            return None  # the cache hasn't seen our last write yet
+        status = deployment.status
+        if (status.observed_generation or 0) < deployment.metadata.generation:
+            return None  # the deployment controller hasn't seen the last spec yet
+        for condition in status.conditions or []:
+            if condition.type == "Progressing" and condition.reason == "ProgressDeadlineExceeded":
                 return False
-        return True if i == 0 else i
+        wanted = deployment.spec.replicas
+        updated = status.updated_replicas or 0
+        if updated < wanted or (status.replicas or 0) > updated or (status.available_replicas or 0) < updated:
+            return None
+        return True
 
     def deploy(self, deploy):
+        # creates the deployment, or updates its spec and annotations if it exists
         res = {}
         try:
-            if self.isDeployExists(deploy.metadata.name):
-                prev = client.AppsV1Api().read_namespaced_deployment(
-                    namespace=self.namespace, name=deploy.metadata.name
-                )
-                deploy.metadata.generation = prev.metadata.generation + 1
-                res = client.AppsV1Api().replace_namespaced_deployment(
-                    namespace=self.namespace, name=deploy.metadata.name, body=deploy,
-                )
+            if self.deployments.get(deploy.metadata.name) is not None:
+                res = self.applySpec(deploy.metadata.name, deploy.spec, deploy.metadata.annotations)
             else:
-                print(f"Deployment {deploy.metadata.name} doesn't exist: creating it.")
-                res = client.AppsV1Api().create_namespaced_deployment(namespace=self.namespace, body=deploy)
-        except ApiException as e:
-            print(f"exception when trying to create or update {deploy.metadata.name}: {e}")
+                eventlog.log("KubernetesInterface", f"Deployment {deploy.metadata.name} doesn't exist: creating it.")
+                res = self._call(self.apps.create_namespaced_deployment, body=deploy, field_manager=FIELD_MANAGER)
+        except rest.ApiException as e:
+            eventlog.warn(
+                "KubernetesInterface", f"exception when trying to create or update {deploy.metadata.name}: {e}"
+            )
         return res
 
+    def applySpec(self, deployment_name: str, spec, annotations=None):
+        # sets the spec of an existing deployment, and adds or updates the given annotations.
+        # In "patch" write mode, only the fields that differ from the cached deployment are sent,
+        # as a JSON patch guarded by its resourceVersion. A conflict with another writer
+        # (409) means our view was stale: the patch is computed again from a fresh read.
+        current = self.deployments.get(deployment_name)
+        for attempt in range(self.conflictRetries + 1):
+            if current is None or self.writeMode == "replace":
+                current = self.getDeploy(deployment_name)  # our own copy, "replace" modifies it
+            try:
+                if self.writeMode == "replace":
+                    current.spec = spec
+                    current.metadata.annotations = dict(current.metadata.annotations or {}, **(annotations or {}))
+                    return self._call(self.apps.replace_namespaced_deployment, name=deployment_name, body=current)
+                patch = self._specPatch(current, spec, annotations or {})
+                if not patch:
+                    return current
+                return self._call(
+                    self.apps.patch_namespaced_deployment,
+                    name=deployment_name,
+                    body=patch,
+                    field_manager=FIELD_MANAGER,
+                )
+            except rest.ApiException as e:
+                if e.status != 409 or attempt == self.conflictRetries:
+                    raise
+                eventlog.log("KubernetesInterface", f"Conflict on {deployment_name}, retrying: {e.reason}")
+                time.sleep(0.1 * 2**attempt)
+                current = None
+
+    def _specPatch(self, current, spec, annotations):
+        # JSON patch (RFC 6902) turning the spec of current into spec and adding annotations.
+        # The resourceVersion makes the API server refuse it if current is outdated.
+        ops = _diff("/spec", self.toDict(current.spec), self.toDict(spec))
+        currentAnnotations = current.metadata.annotations
+        if currentAnnotations is None and annotations:
+            ops += [{"op": "add", "path": "/metadata/annotations", "value": annotations}]
+        else:
+            ops += [
+                {"op": "add", "path": "/metadata/annotations/" + _escape(key), "value": value}
+                for key, value in annotations.items()
+                if currentAnnotations.get(key) != value
+            ]
+        if ops:
+            ops += [{"op": "replace", "path": "/metadata/resourceVersion", "value": current.metadata.resource_version}]
+        return ops
+
     def getPodsList(self, deployment_name: str):
-        def fun(pods):
-            return list(filter(lambda name: deployment_name in name, map(lambda pod: pod.metadata.name, pods),))
+        return [pod.metadata.name for pod in self._getPods(deployment_name)]
+
+    @nonblocking
+    def toDict(self, obj):
+        # the object as the API server sends it: plain dicts and lists, camelCase keys, no null fields
+        return self.serializer.sanitize_for_serialization(obj)
+
+    @nonblocking
+    def receivedAt(self, deployment_name: str):
+        # time.time() at which the informer received the last change of the deployment, None before any
+        return self.deployments.receivedAt.get(deployment_name)
+
+    @nonblocking
+    def countCalls(self):
+        # starts counting the API calls made from the current thread or task, until the next countCalls().
+        # The returned Counter maps API method names to the number of requests sent.
+        counter = collections.Counter()
+        _stepCalls.set(counter)
+        return counter
+
+    def _call(self, func, **kwargs):
+        # every request to the API server goes through here, to be counted.
+        # Identical reads already in flight from another thread are not sent twice,
+        # the caller waits for the pending one and gets its own copy of the result.
+        name = func.__name__
+        if not name.startswith(("read_", "list_")):
+            self._count(name)
+            with metrics.KUBERNETES_REQUESTS.labels(name).time(), tracing.span(name):
+                res = func(namespace=self.namespace, _request_timeout=kubeclient.requestTimeout(), **kwargs)
+            if isinstance(res, client.V1Deployment):
+                with self.lock:
+                    self.written[res.metadata.name] = res.metadata.generation
+            return res
+
+        key = (name, tuple(sorted(kwargs.items())))
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            metrics.KUBERNETES_COALESCED.labels(name).inc()
+            with tracing.span(name, coalesced=True):
+                return copy.deepcopy(flight.get())
+
+        self._count(name)
+        try:
+            with metrics.KUBERNETES_REQUESTS.labels(name).time(), tracing.span(name):
+                flight.result = func(namespace=self.namespace, _request_timeout=kubeclient.requestTimeout(), **kwargs)
+        except Exception as e:
+            flight.error = e
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.done.set()
+        return flight.get()
 
-        return self._iterOnPods(fun, deployment_name)
+    def _count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+        counter = _stepCalls.get()
+        if counter is not None:
+            counter[name] += 1
 
-    def _iterOnPods(self, fun, deployment_name: str):
-        selector = self._getSelector(deployment_name)
-        pods = client.CoreV1Api().list_namespaced_pod(namespace=self.namespace, label_selector=selector).items
-        return fun(pods)
+    def _cachedDeploy(self, deployment_name: str):
+        # the informer copy of the deployment if we have one, otherwise ask the API server
+        deployment = self.deployments.get(deployment_name)
+        if deployment is None:
+            deployment = self.getDeploy(deployment_name)
+        return deployment
+
+    def _getPods(self, deployment_name: str):
+        # pods created by the deployment, looked up by selector in the pod cache.
+        # base, primary and canary share their selector, so pods are also told apart by name.
+        pods = self.pods.select(self._getSelector(deployment_name))
+        return [pod for pod in pods if pod.metadata.name.startswith(deployment_name + "-")]
 
     def _getSelector(self, deployment_name: str):
-        deployment = client.AppsV1Api().read_namespaced_deployment(namespace=self.namespace, name=deployment_name,)
-        selector = ""
-        for key in deployment.spec.selector.match_labels:
-            selector += key + "=" + deployment.spec.selector.match_labels[key] + ","
-        return selector[:-1]
+        return self._cachedDeploy(deployment_name).spec.selector.match_labels
+
+
+# reasons of a waiting or terminated container that won't get better by waiting
+FAULTS = {
+    "CrashLoopBackOff",
+    "ImagePullBackOff",
+    "ErrImagePull",
+    "InvalidImageName",
+    "CreateContainerConfigError",
+    "OOMKilled",
+}
+
+
+def podFault(pod):
+    # why a pod is failing, None if it isn't: a container stuck on one of FAULTS, or restarted
+    statuses = (pod.status.init_container_statuses or []) + (pod.status.container_statuses or [])
+    for status in statuses:
+        for state in (status.state, status.last_state):
+            reason = state and (
+                (state.waiting and state.waiting.reason) or (state.terminated and state.terminated.reason)
+            )
+            if reason in FAULTS:
+                return f"{status.name} {reason}"
+        if status.restart_count:
+            return f"{status.name} restarted {status.restart_count} times"
+    return None
+
+
+def _escape(key):
+    # a key as a JSON pointer token
+    return key.replace("~", "~0").replace("/", "~1")
+
+
+def _diff(path, old, new):
+    # JSON patch operations turning old into new. Dicts are compared key by key,
+    # anything else (lists included) is replaced as a whole when it differs.
+    if old == new:
+        return []
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return [{"op": "replace", "path": path, "value": new}]
+    ops = []
+    for key in old:
+        if key not in new:
+            ops += [{"op": "remove", "path": f"{path}/{_escape(key)}"}]
+    for key, value in new.items():
+        if key not in old:
+            ops += [{"op": "add", "path": f"{path}/{_escape(key)}", "value": value}]
+        else:
+            ops += _diff(f"{path}/{_escape(key)}", old[key], value)
+    return ops
+
+
+class _Flight:
+    # a read request being sent, shared by every caller asking for the same thing meanwhile
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def get(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
@@ -0,0 +1,57 @@
+# deps
+import prometheus_client
+from prometheus_client import Counter, Gauge, Histogram
+
+# Metrics of aviary, served for Prometheus on /metrics of the metrics-port
+
+# latencies from a few ms (cached reads, writes) up to the minutes a rollout can wait on
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+KUBERNETES_REQUESTS = Histogram(
+    "aviary_kubernetes_request_duration_seconds", "Requests to the Kubernetes API server", ["method"], buckets=_BUCKETS
+)
+KUBERNETES_COALESCED = Counter(
+    "aviary_kubernetes_coalesced_reads_total", "Reads answered by an identical request already in flight", ["method"]
+)
+PROMETHEUS_QUERIES = Histogram(
+    "aviary_prometheus_query_duration_seconds",
+    "Queries to Prometheus, retries included",
+    ["endpoint"],
+    buckets=_BUCKETS,
+)
+PROMETHEUS_CACHE_HITS = Counter(
+    "aviary_prometheus_cache_hits_total", "Queries answered by an identical query sent shortly before", ["endpoint"]
+)
+PROMETHEUS_ERRORS = Counter("aviary_prometheus_query_errors_total", "Queries Prometheus couldn't answer", ["endpoint"])
+INFORMER_EVENTS = Counter("aviary_informer_events_total", "Watch events received", ["namespace", "kind", "type"])
+WATCH_LAG = Histogram(
+    "aviary_watch_lag_seconds",
+    "Time between a change of a deployment reaching its informer and its BirdWatcher acting on it",
+    ["service"],
+    buckets=_BUCKETS,
+)
+READINESS_WAITS = Histogram(
+    "aviary_readiness_wait_duration_seconds", "Waits for deployments to be rolled out", ["deployment"], buckets=_BUCKETS
+)
+DECISIONS = Counter(
+    "aviary_decisions_total", "How changes were deployed and how rollouts ended", ["service", "decision"]
+)
+CHECKS = Counter("aviary_canary_checks_total", "Results of checkCanarySuccess", ["service", "result"])
+STEPS = Histogram("aviary_rollout_step_duration_seconds", "Duration of canary steps", ["service"], buckets=_BUCKETS)
+CANARY_FAULTS = Counter(
+    "aviary_canary_pod_faults_total", "Canary rollouts rolled back as soon as a canary pod failed", ["service"]
+)
+ROLLOUT_ACTIVE = Gauge("aviary_rollout_in_progress", "1 while a canary rollout runs", ["service"])
+CANARY_INSTANCES = Gauge("aviary_rollout_canary_instances", "Canary instances of the current step", ["service"])
+ROLLOUT_PROGRESS = Gauge(
+    "aviary_rollout_progress_ratio", "Canary instances of the current step over the breakpoint", ["service"]
+)
+ROLLOUTS_QUEUED = Gauge("aviary_rollouts_queued", "Canary rollouts waiting for their turn, see RolloutScheduler")
+ROLLOUTS_RUNNING = Gauge("aviary_rollouts_running", "Canary rollouts admitted by the RolloutScheduler")
+ROLLOUT_QUEUE_WAIT = Histogram(
+    "aviary_rollout_queue_wait_seconds", "Time canary rollouts waited for their turn", buckets=_BUCKETS
+)
+
+
+def start(port):
+    prometheus_client.start_http_server(port)
@@ -0,0 +1,86 @@
+# std
+import asyncio
+import threading
+import time
+
+
+class Notifier:
+    # A condition variable that threads can wait on, and that coroutines of an
+    # event loop running in another thread can await as well.
+    # Notifications may carry a key (an object name) so that waiting threads and
+    # awaiting coroutines only wake up for the objects they care about.
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.listeners = {}  # key -> callbacks run with the key on notify, None for every notification
+
+    def notify(self, key=None):
+        # must be called with self.cond held. A key of None wakes everyone up.
+        if key is None:
+            listeners = [cb for callbacks in self.listeners.values() for cb in callbacks]
+        else:
+            listeners = list(self.listeners.get(key, ())) + list(self.listeners.get(None, ()))
+        for listener in listeners:
+            listener(key)
+
+    def listen(self, key, callback):
+        # runs callback(key) on every notification of key, or on every notification with a key of None.
+        # It runs with cond held, and must be quick
+        with self.cond:
+            self.listeners.setdefault(key, set()).add(callback)
+
+    def unlisten(self, key, callback):
+        with self.cond:
+            self.listeners[key].discard(callback)
+            if not self.listeners[key]:
+                del self.listeners[key]
+
+    def wait(self, predicate, timeout=None, key=None):
+        # blocks until predicate() is true, re-evaluating it on every notification of key, and on those with
+        # a key of None. Returns False if it was still false after timeout seconds.
+        event = threading.Event()
+
+        def listener(_):
+            event.set()
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.listen(key, listener)
+        try:
+            while True:
+                with self.cond:
+                    # cleared under the lock, a notification sent after the check can't be missed
+                    event.clear()
+                    if predicate():
+                        return True
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                event.wait(remaining)
+        finally:
+            self.unlisten(key, listener)
+
+    async def waitAsync(self, predicate, timeout=None, key=None):
+        # same as wait, without blocking the event loop
+        loop = asyncio.get_event_loop()
+        event = asyncio.Event()
+
+        def listener(_):
+            loop.call_soon_threadsafe(event.set)
+
+        deadline = None if timeout is None else loop.time() + timeout
+        self.listen(key, listener)
+        try:
+            while True:
+                with self.cond:
+                    # cleared under the lock, a notification sent after the check can't be missed
+                    event.clear()
+                    if predicate():
+                        return True
+                remaining = None if deadline is None else deadline - loop.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                try:
+                    await asyncio.wait_for(event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.unlisten(key, listener)
@@ -1,26 +1,158 @@
+# deps
 import requests
+
+# std
+import contextvars
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# sekoia
+import eventlog
+import metrics
+import tracing
+
+
+class PrometheusError(Exception):
+    # Prometheus could not answer the query. An empty result is not an error.
+    pass
 
 
 class PrometheusClient:
-    def __init__(self, url):
+    def __init__(
+        self,
+        url,
+        concurrency=8,
+        timeout=10,
+        retries=3,
+        backoff=0.5,
+        skewRefresh=300,
+        cacheTTL=5,
+        session=None,
+        clock=time.monotonic,
+    ):
         self.baseURL = url + "/api/v1"
         self.queryURL = self.baseURL + "/query"
+        self.rangeURL = self.baseURL + "/query_range"
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)  # runs getLastValues queries side by side
+        self.timeout = timeout  # seconds, for connecting and for each read
+        self.retries = retries  # extra attempts on connection errors and 5xx answers
+        self.backoff = backoff  # seconds before the first retry, doubled for each next one
+
+        # keep-alive connections, enough for every query of getLastValues to have one.
+        # Another session can be given, to run against a fake Prometheus, see simulator.py
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+
+        # results are shared by identical queries sent within cacheTTL seconds of each other, by several
+        # services checking the same expression. clock measures those seconds, see simulator.py
+        self.cacheTTL = cacheTTL
+        self.clock = clock
+        self.cache = {}  # (endpoint, query, ...) -> (expiry, Future of the result)
+        self.cachePurgedAt = clock()
+        self.cacheLock = threading.Lock()
+
+        # queries are evaluated at the time of the Prometheus server, not ours.
+        # The offset between the two clocks is measured every skewRefresh seconds.
+        self.skew = 0
+        self.skewRefresh = skewRefresh
+        self.skewMeasuredAt = None
+        self.skewLock = threading.Lock()
 
     def getLastValue(self, query):
-        r_time = requests.get(self.queryURL, params={"query": "time()"})
-        current_time = time.time()
-        if r_time.status_code == 200:
-            result = r_time.json()["data"]["result"]
-            if len(result):
-                current_time = result[0]
-
-        r = requests.get(self.queryURL, params={"time": current_time, "query": query})
-        if r.status_code == 200:
-            result = r.json()["data"]["result"]
-            if len(result):
-                return result[0]["value"][1]
-            else:
-                return None
-        else:
-            return False
+        # first value returned by the query, None if it returned nothing
+        result = self.getVector(query)
+        if len(result):
+            return result[0]["value"][1]
+        return None
+
+    def getLastValues(self, queries):
+        # getLastValue of every query, sent concurrently. Results are in the order of the queries.
+        # Each runs in a copy of the caller's context, to be traced in its current span
+        futures = [self.pool.submit(contextvars.copy_context().run, self.getLastValue, query) for query in queries]
+        return [future.result() for future in futures]
+
+    def getVector(self, query):
+        # every sample returned by an instant query, as {"metric": {labels}, "value": [ts, value]}
+        return self._cached(("query", query), lambda: self._query({"time": self.now(), "query": query})["result"])
+
+    def getRange(self, query, window, resolution):
+        # every series returned by a range query over the last window seconds,
+        # as {"metric": {labels}, "values": [[ts, value], ...]}
+        def fetch():
+            end = self.now()
+            params = {"query": query, "start": end - window, "end": end, "step": resolution}
+            return self._query(params, self.rangeURL)["result"]
+
+        return self._cached(("query_range", query, window, resolution), fetch)
+
+    def _cached(self, key, fetch):
+        # result of fetch() for key, or of the identical query sent less than cacheTTL seconds ago,
+        # waiting for it if it is still in flight. Errors aren't kept
+        if not self.cacheTTL:
+            return fetch()
+        now = self.clock()
+        with self.cacheLock:
+            if now - self.cachePurgedAt > self.cacheTTL:
+                self.cache = {k: entry for k, entry in self.cache.items() if entry[0] > now}
+                self.cachePurgedAt = now
+            entry = self.cache.get(key)
+            hit = entry is not None and entry[0] > now
+            if not hit:
+                entry = (now + self.cacheTTL, Future())
+                self.cache[key] = entry
+        future = entry[1]
+        if hit:
+            metrics.PROMETHEUS_CACHE_HITS.labels(key[0]).inc()
+            return future.result()
+        try:
+            future.set_result(fetch())
+        except Exception as e:
+            future.set_exception(e)
+            with self.cacheLock:
+                if self.cache.get(key) is entry:
+                    del self.cache[key]
+        return future.result()
+
+    def now(self):
+        # current time on the Prometheus server
+        with self.skewLock:
+            if self.skewMeasuredAt is None or time.monotonic() - self.skewMeasuredAt > self.skewRefresh:
+                self._measureSkew()
+            return time.time() + self.skew
+
+    def _measureSkew(self):
+        self.skewMeasuredAt = time.monotonic()
+        try:
+            sent = time.time()
+            result = self._query({"query": "time()"})["result"]
+            received = time.time()
+            self.skew = float(result[0]) - (sent + received) / 2
+        except PrometheusError as e:
+            eventlog.warn("PrometheusClient", f"Couldn't get the server time, keeping a skew of {self.skew}s: {e}")
+
+    def _query(self, params, url=None):
+        url = url or self.queryURL
+        endpoint = url.rsplit("/", 1)[-1]
+        with metrics.PROMETHEUS_QUERIES.labels(endpoint).time(), tracing.span(endpoint, query=params["query"]):
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    tracing.annotate(retries=attempt)
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+                try:
+                    # form-encoded, long queries would exceed the URL length limit of GET
+                    r = self.session.post(url, data=params, timeout=self.timeout)
+                except requests.RequestException as e:
+                    error = e
+                    continue
+                if r.status_code == 200:
+                    return r.json()["data"]
+                error = f"HTTP {r.status_code}: {r.text[:200]}"
+                if r.status_code < 500 and r.status_code != 429:  # the query itself is wrong, retrying won't help
+                    break
+        metrics.PROMETHEUS_ERRORS.labels(endpoint).inc()
+        raise PrometheusError(f"{params['query']}: {error}")
@@ -0,0 +1,128 @@
+# std
+import re
+
+POD_TAG = "<<pod>>"
+
+# matches `label="<<pod>>"`, the only form of the tag we know how to widen to several pods
+_POD_MATCHER = re.compile(r'(\w+)\s*=\s*"' + POD_TAG + '"')
+
+
+# aggregation operators, and functions whose result has none of the labels of their argument
+_AGGREGATION = re.compile(
+    r"\b(sum|min|max|avg|group|stddev|stdvar|count|count_values|bottomk|topk|quantile)\s*(?=\(|by\b|without\b)"
+)
+_LABEL_DROPPING = re.compile(r"\b(absent|absent_over_time|scalar|vector)\s*\(")
+_GROUPING = re.compile(r"\s*(by|without)\s*\(([^)]*)\)")
+_VECTOR_MATCHING = re.compile(r"\b(on|ignoring)\s*\(([^)]*)\)")
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|`[^`]*`')
+
+
+def batchQuery(expr, pods):
+    # rewrites every `label="<<pod>>"` of the expression into `label=~"pod-a|pod-b"`,
+    # so a single query returns one sample per pod, told apart by that label.
+    # Returns (query, label), or None if the expression can't be rewritten and has
+    # to be sent once per pod.
+    labels = set(_POD_MATCHER.findall(expr))
+    if len(labels) != 1 or expr.count(POD_TAG) != len(_POD_MATCHER.findall(expr)):
+        return None
+    label = labels.pop()
+    if not keepsLabel(expr, label):
+        return None
+    return _POD_MATCHER.sub(f'{label}=~"{podRegex(pods)}"', expr), label
+
+
+def keepsLabel(expr, label):
+    # whether the samples of expr still carry label: every aggregation groups by it, and nothing
+    # else drops it. `sum(rate(x{pod="<<pod>>"}[1m])) < 1` doesn't, its sum over every pod of a batch
+    # could fail while each pod alone passes
+    expr = _STRING.sub('""', expr)
+    if _LABEL_DROPPING.search(expr):
+        return False
+    for match in _VECTOR_MATCHING.finditer(expr):
+        names = {name.strip() for name in match.group(2).split(",")}
+        if (match.group(1) == "on") != (label in names):
+            return False
+    for match in _AGGREGATION.finditer(expr):
+        grouping = _GROUPING.match(expr, match.end())  # sum by (pod) (...)
+        if grouping is None:
+            grouping = _GROUPING.match(expr, _closingParen(expr, match.end()) + 1)  # sum(...) by (pod)
+        if grouping is None:
+            return False
+        names = {name.strip() for name in grouping.group(2).split(",")}
+        if (grouping.group(1) == "by") != (label in names):
+            return False
+    return True
+
+
+def _closingParen(expr, start):
+    # index of the parenthesis closing the one at start, or of the end of expr if it isn't closed
+    depth = 0
+    for i in range(start, len(expr)):
+        if expr[i] == "(":
+            depth += 1
+        elif expr[i] == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+    return len(expr)
+
+
+DEPLOYMENT_TAG = "<<deployment>>"
+NAMESPACE_TAG = "<<namespace>>"
+PRIMARY_PODS_TAG = "<<primary_pods>>"
+
+_TAG = re.compile(r"<<\w+>>")
+
+
+def podRegex(pods):
+    # a PromQL regex matching exactly the given pods. Pod names are DNS subdomains, '.' is the only
+    # character with a meaning in a regex. The backslash itself needs escaping inside a PromQL string.
+    return "|".join(pod.replace(".", "\\\\.") for pod in pods)
+
+
+class QueryTemplate:
+    # A success expression of canaries.yaml, parsed once. Besides <<pod>>, it can use:
+    # - <<deployment>> and <<namespace>>: the base deployment of the service and its namespace
+    # - <<primary_pods>>: a regex of the primary pods, for `label=~"<<primary_pods>>"`
+    # The queries rendered for a set of pods are kept until the pods change.
+    def __init__(self, expr):
+        for tag in set(_TAG.findall(expr)) - {POD_TAG, DEPLOYMENT_TAG, NAMESPACE_TAG, PRIMARY_PODS_TAG}:
+            raise ValueError(f"unknown placeholder {tag} in {expr}")
+        self.expr = expr
+        self.batchable = batchQuery(expr, []) is not None  # a single query can check every pod
+        self.rendered = (None, {})  # (pods, primaryPods, deployment, namespace) and what was rendered for them
+
+    def batch(self, pods, primaryPods, deployment, namespace):
+        # batchQuery of the expression for pods, None if it isn't batchable
+        if not self.batchable:
+            return None
+        return self._render("batch", pods, primaryPods, deployment, namespace)
+
+    def perPod(self, pods, primaryPods, deployment, namespace):
+        # [(pod, query)], one query for each pod
+        return self._render("perPod", pods, primaryPods, deployment, namespace)
+
+    def forPod(self, pod, primaryPods, deployment, namespace):
+        # the query of a single pod, as logged when the pod fails
+        return self.bind(primaryPods, deployment, namespace).replace(POD_TAG, pod)
+
+    def _render(self, kind, pods, primaryPods, deployment, namespace):
+        key = (tuple(pods), tuple(primaryPods), deployment, namespace)
+        if self.rendered[0] != key:
+            self.rendered = (key, {})
+        rendered = self.rendered[1]
+        if kind not in rendered:
+            expr = self.bind(primaryPods, deployment, namespace)
+            if kind == "batch":
+                rendered[kind] = batchQuery(expr, pods)
+            else:
+                rendered[kind] = [(pod, expr.replace(POD_TAG, pod)) for pod in pods]
+        return rendered[kind]
+
+    def bind(self, primaryPods, deployment, namespace):
+        # the expression with every placeholder but <<pod>> filled
+        return (
+            self.expr.replace(DEPLOYMENT_TAG, deployment)
+            .replace(NAMESPACE_TAG, namespace)
+            .replace(PRIMARY_PODS_TAG, podRegex(primaryPods))
+        )
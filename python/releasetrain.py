@@ -0,0 +1,160 @@
+# std
+import itertools
+
+# sekoia
+from engine import nonblocking
+from notifier import Notifier
+
+
+class _Run:
+    # one rollout of a group: the services that boarded it, and how far each of them went
+    def __init__(self, departsAt, seq):
+        self.departsAt = departsAt  # engine time at which boarding closes
+        self.seq = seq
+        self.riders = []  # BirdWatchers, in boarding order
+        self.requests = {}  # rider -> (priority, cpu, memory) of its rollout, see RolloutScheduler
+        self.closed = False
+        self.ticket = None  # of the whole group in the RolloutScheduler
+        self.phases = {}  # rider -> last phase it reached, see align
+        self.done = set()  # riders that reached their breakpoint, waiting for the others to promote
+        self.ticks = {}  # (step, check) -> result of the check of the group, None while it is evaluated
+        self.failed = None  # why the group rolls back, once a rider failed
+
+
+class ReleaseTrain:
+    # Services of a group in canaries.yaml, as an API and its workers, rolled out together.
+    # Services of the group whose base deployment changed within boarding seconds of the first one ride
+    # the same run. Each of them runs its own deployCanary, and they meet here:
+    # - riders start each step together, and start checking it together, see align
+    # - every check of a step is evaluated once for all riders, by the first one asking, see claim
+    # - a rider reaching its breakpoint waits for the others, see finish, and as soon as one rider fails,
+    #   every rider rolls back
+    # A run goes through the RolloutScheduler as one rollout, its requests being those of every rider.
+    # Waits work from threads and coroutines alike, see Notifier.
+    def __init__(self, name, boarding=60, scheduler=None):
+        self.name = name
+        self.boarding = boarding  # seconds
+        self.scheduler = scheduler  # RolloutScheduler, None to start runs at once
+        self.notifier = Notifier()  # notified with the seq of runs when one changes
+        self.cond = self.notifier.cond
+        self.run = None  # boarding, or the last one that departed
+        self.seq = itertools.count()
+
+    @nonblocking
+    def board(self, rider, now, priority=0, cpu=0, memory=0):
+        # the run rider rides: the one boarding, or a new one departing boarding seconds after now
+        with self.cond:
+            if self.run is None or self.run.closed:
+                self.run = _Run(now + self.boarding, next(self.seq))
+            self.run.riders = self.run.riders + [rider]  # replaced, never mutated, to be read without cond
+            self.run.requests[rider] = (priority, cpu, memory)
+            return self.run
+
+    @nonblocking
+    def close(self, run, namespace):
+        # ends boarding, run then waits for its turn in the scheduler. Returns True for the first rider calling it
+        with self.cond:
+            if run.closed:
+                return False
+            run.closed = True
+            if self.scheduler is not None:
+                requests = run.requests.values()
+                run.ticket = self.scheduler.enqueue(
+                    f"{namespace}/{self.name}",
+                    namespace,
+                    max(priority for priority, _, _ in requests),
+                    sum(cpu for _, cpu, _ in requests),
+                    sum(memory for _, _, memory in requests),
+                )
+            return True
+
+    @nonblocking
+    def leave(self, run, rider):
+        # rider is done with run, or stopped. The last one to leave ends the run in the scheduler
+        with self.cond:
+            run.riders = [r for r in run.riders if r is not rider]
+            run.done.discard(rider)
+            if not run.riders and run.ticket is not None:
+                self.scheduler.release(run.ticket)
+            self.notifier.notify(run.seq)
+
+    @nonblocking
+    def wake(self, run):
+        # wakes up the riders waiting on run, to see whether they were stopped
+        with self.cond:
+            self.notifier.notify(run.seq)
+
+    @nonblocking
+    def reach(self, run, rider, phase):
+        # rider reached phase of its rollout, a number growing as it goes through its steps
+        with self.cond:
+            run.phases[rider] = phase
+            self.notifier.notify(run.seq)
+
+    def align(self, run, phase, timeout=None):
+        # waits until every rider reached phase, or reached its breakpoint, or until one of them failed.
+        # Returns False if that still wasn't the case after timeout seconds
+        return self.notifier.wait(lambda: self._aligned(run, phase), timeout, key=run.seq)
+
+    async def alignAsync(self, run, phase, timeout=None):
+        return await self.notifier.waitAsync(lambda: self._aligned(run, phase), timeout, key=run.seq)
+
+    def _aligned(self, run, phase):
+        return run.failed is not None or all(r in run.done or run.phases.get(r, 0) >= phase for r in run.riders)
+
+    @nonblocking
+    def claim(self, run, tick):
+        # True for the first rider asking, which evaluates the check of the group and settles it
+        with self.cond:
+            if tick in run.ticks:
+                return False
+            run.ticks[tick] = None
+            return True
+
+    @nonblocking
+    def checking(self, run):
+        # riders whose canaries are checked: those still going through their steps
+        with self.cond:
+            return [r for r in run.riders if r not in run.done]
+
+    @nonblocking
+    def settle(self, run, tick, success):
+        with self.cond:
+            run.ticks[tick] = success
+            self.notifier.notify(run.seq)
+
+    def result(self, run, tick, timeout=None):
+        # waits for the result of the check of the group claimed by another rider, None after timeout seconds
+        self.notifier.wait(lambda: run.ticks.get(tick) is not None, timeout, key=run.seq)
+        return run.ticks.get(tick)
+
+    async def resultAsync(self, run, tick, timeout=None):
+        await self.notifier.waitAsync(lambda: run.ticks.get(tick) is not None, timeout, key=run.seq)
+        return run.ticks.get(tick)
+
+    @nonblocking
+    def fail(self, run, rider, reason):
+        # rider failed, the group rolls back. Returns the riders to wake up, the first time only
+        with self.cond:
+            if run.failed is not None:
+                return []
+            run.failed = f"{rider.baseDeploymentName} {reason}"
+            self.notifier.notify(run.seq)
+            return [r for r in run.riders if r is not rider]
+
+    @nonblocking
+    def finish(self, run, rider):
+        # rider reached its breakpoint
+        with self.cond:
+            run.done.add(rider)
+            self.notifier.notify(run.seq)
+
+    def finished(self, run, timeout=None):
+        # waits until every rider reached its breakpoint, or one of them failed
+        return self.notifier.wait(lambda: self._finished(run), timeout, key=run.seq)
+
+    async def finishedAsync(self, run, timeout=None):
+        return await self.notifier.waitAsync(lambda: self._finished(run), timeout, key=run.seq)
+
+    def _finished(self, run):
+        return run.failed is not None or all(r in run.done for r in run.riders)
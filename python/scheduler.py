@@ -0,0 +1,140 @@
+# std
+import itertools
+import re
+import time
+
+# sekoia
+import metrics
+from engine import nonblocking
+from notifier import Notifier
+
+# suffixes of Kubernetes quantities, as in "100m" CPU or "512Mi" memory
+_SUFFIXES = {
+    "n": 1e-9,
+    "u": 1e-6,
+    "m": 1e-3,
+    "": 1,
+    "k": 1e3,
+    "M": 1e6,
+    "G": 1e9,
+    "T": 1e12,
+    "P": 1e15,
+    "E": 1e18,
+    "Ki": 2**10,
+    "Mi": 2**20,
+    "Gi": 2**30,
+    "Ti": 2**40,
+    "Pi": 2**50,
+    "Ei": 2**60,
+}
+# a signed decimal number, then a suffix or a decimal exponent ("129e6"). "2E" is 2 exa, an exponent has digits
+_QUANTITY = re.compile(r"([+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))(?:[eE]([+-]?[0-9]+)|(Ki|Mi|Gi|Ti|Pi|Ei|[numkMGTPE])?)")
+
+
+def parseQuantity(quantity):
+    # "100m", "2", "512Mi", "1G" or "1e3" to a number of cores or bytes, None stays None.
+    # Raises ValueError if it isn't a Kubernetes quantity
+    if quantity is None or isinstance(quantity, (int, float)):
+        return quantity
+    match = _QUANTITY.fullmatch(str(quantity).strip())
+    if match is None:
+        raise ValueError(f"{quantity} isn't a quantity")
+    number, exponent, suffix = match.groups()
+    if exponent is not None:
+        return float(number) * 10 ** int(exponent)
+    return float(number) * _SUFFIXES[suffix or ""]
+
+
+class _Ticket:
+    # a canary rollout waiting for its turn, or running once admitted
+    def __init__(self, key, namespace, priority, cpu, memory, seq):
+        self.key = key  # namespace/service
+        self.namespace = namespace
+        self.priority = priority
+        self.cpu = cpu  # extra requests of a canary step, in cores and bytes
+        self.memory = memory
+        self.order = (-priority, seq)  # higher priority first, then first come first served
+        self.admitted = False
+        self.queuedAt = time.monotonic()
+
+
+class RolloutScheduler:
+    # Lets canary rollouts start, by priority then in arrival order, as long as:
+    # - at most limit run at once, and at most namespaceLimit in each namespace (None for no limit)
+    # - the extra CPU and memory requested by their canary steps fit in cpuBudget and memoryBudget
+    # A rollout held back by the limit of its namespace doesn't hold back rollouts of other namespaces.
+    # One held back by the budgets holds back those after it, so that large rollouts aren't starved,
+    # and starts alone when it exceeds the budgets by itself.
+    # Waits work from threads and coroutines alike, as those of the informers, see Notifier.
+    def __init__(self, limit=None, namespaceLimit=None, cpuBudget=None, memoryBudget=None):
+        self.limit = limit
+        self.namespaceLimit = namespaceLimit
+        self.cpuBudget = cpuBudget
+        self.memoryBudget = memoryBudget
+        self.notifier = Notifier()  # notified with the key of tickets when they are admitted
+        self.cond = self.notifier.cond
+        self.queue = []  # tickets waiting, in the order they will be admitted
+        self.running = []  # tickets admitted and not released yet
+        self.seq = itertools.count()
+
+    @nonblocking
+    def enqueue(self, key, namespace, priority=0, cpu=0, memory=0):
+        # a ticket for a rollout of the service key, admitted right away if every limit allows it
+        ticket = _Ticket(key, namespace, priority, cpu, memory, next(self.seq))
+        with self.cond:
+            self.queue = sorted(self.queue + [ticket], key=lambda t: t.order)
+            self._schedule()
+        return ticket
+
+    def admit(self, ticket, timeout=None):
+        # waits until the ticket is admitted, returns False if it still wasn't after timeout seconds
+        return self.notifier.wait(lambda: ticket.admitted, timeout, key=ticket.key)
+
+    async def admitAsync(self, ticket, timeout=None):
+        return await self.notifier.waitAsync(lambda: ticket.admitted, timeout, key=ticket.key)
+
+    @nonblocking
+    def release(self, ticket):
+        # ends the rollout of the ticket, or takes it out of the queue if it wasn't admitted
+        with self.cond:
+            if ticket.admitted:
+                self.running = [t for t in self.running if t is not ticket]
+            else:
+                self.queue = [t for t in self.queue if t is not ticket]
+            self._schedule()
+
+    @nonblocking
+    def position(self, ticket):
+        # 1 for the next rollout to start, None when the ticket isn't queued
+        with self.cond:
+            return next((i + 1 for i, t in enumerate(self.queue) if t is ticket), None)
+
+    def _schedule(self):
+        # admits every queued ticket the limits allow, must be called with cond held
+        admitted = []
+        for ticket in self.queue:
+            if self.limit is not None and len(self.running) >= self.limit:
+                break
+            if self.namespaceLimit is not None and self._count(ticket.namespace) >= self.namespaceLimit:
+                continue
+            if self.running and not self._fits(ticket):
+                break
+            ticket.admitted = True
+            self.running += [ticket]
+            admitted += [ticket]
+            metrics.ROLLOUT_QUEUE_WAIT.observe(time.monotonic() - ticket.queuedAt)
+        self.queue = [t for t in self.queue if not t.admitted]
+        metrics.ROLLOUTS_QUEUED.set(len(self.queue))
+        metrics.ROLLOUTS_RUNNING.set(len(self.running))
+        for ticket in admitted:
+            self.notifier.notify(ticket.key)
+
+    def _count(self, namespace):
+        return sum(t.namespace == namespace for t in self.running)
+
+    def _fits(self, ticket):
+        cpu = sum(t.cpu for t in self.running) + ticket.cpu
+        memory = sum(t.memory for t in self.running) + ticket.memory
+        return (self.cpuBudget is None or cpu <= self.cpuBudget) and (
+            self.memoryBudget is None or memory <= self.memoryBudget
+        )
@@ -0,0 +1,201 @@
+# std
+import bisect
+import datetime
+import hashlib
+import threading
+import time
+
+# sekoia
+import eventlog
+import kubeclient
+from kubeclient import client, rest
+
+SHARD_PREFIX = "aviary-shard-"  # Lease of each shard, held by the replica driving its services
+MEMBER_PREFIX = "aviary-replica-"  # Lease of each replica, renewed to be counted live
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def _now():
+    # the API server wants microseconds, which isoformat leaves out when there are none
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return now.replace(microsecond=now.microsecond or 1)
+
+
+def _alive(lease, now):
+    spec = lease.spec
+    if not spec.holder_identity or spec.renew_time is None:
+        return False
+    return spec.renew_time + datetime.timedelta(seconds=spec.lease_duration_seconds) > now
+
+
+class HashRing:
+    # consistent hashing of services on shards: changing the number of shards
+    # only moves the services of the shards added or removed
+    def __init__(self, shards, points=64):
+        self.points = sorted((_hash(f"{shard}-{i}"), shard) for shard in range(shards) for i in range(points))
+        self.hashes = [h for h, _ in self.points]
+
+    def shard(self, key):
+        return self.points[bisect.bisect(self.hashes, _hash(key)) % len(self.points)][1]
+
+
+def owner(shard, members):
+    # replica a shard goes to, by rendezvous hashing: a replica joining or leaving
+    # only moves the shards it takes or gives back
+    return max(members, key=lambda member: _hash(f"{member}/{shard}"))
+
+
+class ShardManager:
+    # Spreads shards over the live replicas of aviary. Each shard has a Lease, so a shard is never
+    # driven by two replicas: it is taken once free or expired, renewed every leaseDuration / 3,
+    # and dropped when it couldn't be renewed for 2/3 of leaseDuration, before anyone else can take it.
+    # Each replica also has a member Lease, deleted when it shuts down, see leave. Those of replicas
+    # that didn't, expired for over leaseDuration, are deleted by the others.
+    def __init__(self, shards, namespace, identity, onAcquire, onLose, canRelease, leaseDuration=15):
+        self.shards = shards
+        self.namespace = namespace
+        self.identity = identity  # name of this replica, its pod name
+        self.onAcquire = onAcquire  # called with a shard once its Lease is ours
+        self.onLose = onLose  # called with a shard we don't hold anymore, its services must stop now
+        self.canRelease = canRelease  # called with a shard that moves to another replica, False delays it
+        self.leaseDuration = leaseDuration
+        self.held = {}  # shard -> time.monotonic() of its last renewal
+        self.api = kubeclient.api("CoordinationV1Api")
+        self.timeout = min(kubeclient.requestTimeout(), leaseDuration / 3)  # of requests, renewals can't wait
+        self.thread = threading.Thread(target=self.run, name="shards", daemon=True)
+        self.lock = threading.Lock()  # held by reconcile, so that leave doesn't race with a renewal
+        self.left = False
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while True:
+            with self.lock:
+                if self.left:
+                    return
+                try:
+                    self.reconcile()
+                except rest.ApiException as e:
+                    eventlog.warn("ShardManager", f"Couldn't reconcile shards: {e.status} {e.reason}")
+                self.expire()
+            time.sleep(self.leaseDuration / 3)
+
+    def leave(self):
+        # deletes the member Lease of this replica as it shuts down, so that the others stop counting it
+        # right away. Its shards go to them once their Leases expire, as its services may still be running
+        with self.lock:
+            self.left = True
+            name = MEMBER_PREFIX + self.identity
+            try:
+                lease = self.api.read_namespaced_lease(name, self.namespace, _request_timeout=self.timeout)
+            except rest.ApiException as e:
+                if e.status != 404:
+                    eventlog.warn("ShardManager", f"Couldn't delete {name}, it will expire: {e.status} {e.reason}")
+                return
+            self._delete(name, lease)
+
+    def reconcile(self):
+        now = _now()
+        leases = {
+            lease.metadata.name: lease
+            for lease in self.api.list_namespaced_lease(self.namespace, _request_timeout=self.timeout).items
+        }
+        self._take(MEMBER_PREFIX + self.identity, leases.get(MEMBER_PREFIX + self.identity), now)
+        members = {
+            lease.spec.holder_identity
+            for name, lease in leases.items()
+            if name.startswith(MEMBER_PREFIX) and _alive(lease, now)
+        } | {self.identity}
+        self._collect(leases, now)
+
+        for shard in range(self.shards):
+            name = f"{SHARD_PREFIX}{shard}"
+            if owner(shard, members) != self.identity and shard in self.held and self.canRelease(shard):
+                eventlog.log("ShardManager", f"Handing shard {shard} over to {owner(shard, members)}")
+                del self.held[shard]
+                self.onLose(shard)
+                self._release(name, leases.get(name))
+            elif owner(shard, members) == self.identity or shard in self.held:
+                if self._take(name, leases.get(name), now):
+                    if shard not in self.held:
+                        eventlog.log("ShardManager", f"Acquired shard {shard}")
+                        self.held[shard] = time.monotonic()
+                        self.onAcquire(shard)
+                    self.held[shard] = time.monotonic()
+                elif shard in self.held:
+                    eventlog.log("ShardManager", f"Shard {shard} was taken by another replica")
+                    del self.held[shard]
+                    self.onLose(shard)
+
+    def expire(self):
+        # shards we failed to renew for too long may soon be taken by another replica
+        for shard, renewed in list(self.held.items()):
+            if time.monotonic() - renewed > self.leaseDuration * 2 / 3:
+                eventlog.warn("ShardManager", f"Couldn't renew shard {shard} in time, dropping it")
+                del self.held[shard]
+                self.onLose(shard)
+
+    def _take(self, name, lease, now):
+        # creates, renews or takes over an expired Lease. Returns whether we hold it
+        if lease is None:
+            lease = client.V1Lease(
+                metadata=client.V1ObjectMeta(name=name),
+                spec=client.V1LeaseSpec(lease_duration_seconds=self.leaseDuration, lease_transitions=0),
+            )
+        elif lease.spec.holder_identity != self.identity and _alive(lease, now):
+            return False
+        if lease.spec.holder_identity != self.identity:
+            lease.spec.holder_identity = self.identity
+            lease.spec.acquire_time = now
+            lease.spec.lease_transitions = (lease.spec.lease_transitions or 0) + 1
+        lease.spec.renew_time = now
+        lease.spec.lease_duration_seconds = self.leaseDuration
+        try:
+            if lease.metadata.resource_version is None:
+                self.api.create_namespaced_lease(self.namespace, lease, _request_timeout=self.timeout)
+            else:
+                # guarded by its resourceVersion
+                self.api.replace_namespaced_lease(name, self.namespace, lease, _request_timeout=self.timeout)
+        except rest.ApiException as e:
+            if e.status == 409:  # another replica wrote it first
+                return False
+            raise
+        return True
+
+    def _collect(self, leases, now):
+        # deletes the member Leases of replicas gone for over leaseDuration, as every restart of aviary
+        # that couldn't leave would otherwise add one for good
+        gone = now - datetime.timedelta(seconds=self.leaseDuration)
+        for name, lease in leases.items():
+            if name.startswith(MEMBER_PREFIX) and name != MEMBER_PREFIX + self.identity and not _alive(lease, gone):
+                if self._delete(name, lease):
+                    eventlog.log("ShardManager", f"Deleted {name}, its replica is gone")
+
+    def _delete(self, name, lease):
+        # deletes a Lease unless it changed since it was read. Returns whether it was deleted
+        options = client.V1DeleteOptions(
+            preconditions=client.V1Preconditions(resource_version=lease.metadata.resource_version)
+        )
+        try:
+            self.api.delete_namespaced_lease(name, self.namespace, body=options, _request_timeout=self.timeout)
+        except rest.ApiException as e:
+            if e.status not in (404, 409):  # already deleted, or renewed meanwhile
+                eventlog.warn("ShardManager", f"Couldn't delete {name}: {e.status} {e.reason}")
+            return False
+        return True
+
+    def _release(self, name, lease):
+        # frees a Lease right away, instead of letting the next replica wait for it to expire
+        if lease is None or lease.spec.holder_identity != self.identity:
+            return
+        lease.spec.holder_identity = None
+        lease.spec.renew_time = None
+        try:
+            self.api.replace_namespaced_lease(name, self.namespace, lease, _request_timeout=self.timeout)
+        except rest.ApiException as e:
+            eventlog.warn("ShardManager", f"Couldn't release {name}, it will expire: {e.status} {e.reason}")
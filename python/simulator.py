@@ -0,0 +1,596 @@
+# deps
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+# std
+import asyncio
+import collections
+import concurrent.futures
+import copy
+import hashlib
+import itertools
+import json
+import re
+import selectors
+import sys
+import threading
+import time
+import uuid
+
+# sekoia
+import eventlog
+from birdwatcher import BirdWatcher
+from engine import AsyncioEngine, ThreadEngine, runSync
+from kubernetesinterface import KubernetesInterface
+from prometheusclient import PrometheusClient
+
+# Runs BirdWatchers in process against a fake Kubernetes API and a fake Prometheus, on virtual time:
+# every sleep and timeout moves a clock instead of waiting, so a rollout of hours ends in milliseconds.
+# KubernetesInterface takes the fake cluster as its api, PrometheusClient the fake Prometheus as its session.
+# The threads engine can't skip time, its watchers block their threads: it is simulated in real time,
+# with durations of a fraction of a second, see ThreadSimulatedEngine.
+# Used by resources/tests/benchmark.py and resources/tests/scenarios.py, and to replay rollouts by hand:
+#
+#   python simulator.py [services] [failing services] [simulated|threads]
+
+SIMULATION_START = 1_600_000_000.0  # virtual clock on startup, timestamps look like real ones
+
+# config of every simulated service, one batched success query
+SERVICE_CONFIG = {
+    "breakpoint": "50%",
+    "step": "10%",
+    "abort": "120s",
+    "max_step_duration": "600s",
+    "check_max_failures": 3,
+    "check_success_step_duration": "60s",
+    "start_delay": "30s",
+    "success": [{"expr": 'sum by (pod) (rate(http_requests_total{pod="<<pod>>", code!~"5.."}[1m])) > 0'}],
+}
+
+# how a rollout of the simulation can end, see BirdWatcher.recordDecision
+OUTCOMES = ("promoted", "rolled back", "aborted", "direct", "bypass", "scale", "ignore")
+
+
+class _SkippingSelector(selectors.DefaultSelector):
+    # never blocks: when nothing is ready, the clock of the loop jumps to the end of the timeout
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if not events and timeout:
+            self.clock.advance(timeout)
+        return events
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    # an event loop whose time only moves when every task is waiting
+    def __init__(self, start=SIMULATION_START):
+        self.virtualTime = start
+        super().__init__(_SkippingSelector(self))
+        # timers due within the resolution run, it must exceed the float precision of the clock (~1e-7s)
+        self._clock_resolution = 1e-3
+
+    def time(self):
+        return self.virtualTime
+
+    def advance(self, seconds):
+        self.virtualTime += seconds
+
+    def call_at(self, when, callback, *args, context=None):
+        # timers due within the resolution run early, the clock then moves to their time. Otherwise a wait
+        # with less than the resolution left would wake up, see it isn't over and wait again, forever
+        return super().call_at(when, self._runAt, when, callback, *args, context=context)
+
+    def _runAt(self, when, callback, *args):
+        self.virtualTime = max(self.virtualTime, when)
+        callback(*args)
+
+
+class SimulatedEngine(AsyncioEngine):
+    # the asyncio engine on a VirtualClockLoop run by the calling thread. Client calls are made
+    # directly from the loop, the fake backends answer them without waiting
+    name = "simulated"
+
+    def __init__(self, poolSize=None, start=SIMULATION_START):
+        self.loop = VirtualClockLoop(start)
+        asyncio.set_event_loop(self.loop)
+        self.tasks = []
+
+    def serve(self, backend):
+        # the fake backend as clients call it, directly from the loop
+        return backend
+
+    async def _call(self, method, *args, **kwargs):
+        return method(*args, **kwargs)
+
+    def time(self):
+        return self.loop.time()
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def spawn(self, coro, name=None):
+        self.tasks += [self.loop.create_task(coro)]
+
+    def wait(self):
+        self.run(asyncio.gather(*self.tasks))
+
+    def runUntil(self, predicate, timeout, interval=10):
+        # runs the loop until predicate() is true, checked every interval virtual seconds.
+        # Returns False if it was still false after timeout virtual seconds
+        async def until():
+            deadline = self.loop.time() + timeout
+            while not predicate():
+                if self.loop.time() >= deadline:
+                    return False
+                await asyncio.sleep(interval)
+            return True
+
+        return self.run(until())
+
+
+class RealClockLoop(asyncio.SelectorEventLoop):
+    # an event loop on the clock of time.time(), as the threads engine, for timestamps to agree
+    def time(self):
+        return time.time()
+
+
+class ThreadSimulatedEngine(ThreadEngine):
+    # the threads engine, in real time. The fake backends aren't thread-safe: they run on an event loop
+    # of their own thread, and every call of the watchers goes through it, see serve.
+    # Watchers run on daemon threads, so that a simulation left running doesn't keep the process alive
+    name = "threads"
+
+    def __init__(self, poolSize=None):
+        super().__init__(poolSize)
+        self.loop = RealClockLoop()
+        threading.Thread(target=self.loop.run_forever, name="fake-backends", daemon=True).start()
+
+    def serve(self, backend):
+        return _OnLoop(backend, self.loop)
+
+    def spawn(self, coro, name=None):
+        thread = threading.Thread(target=runSync, args=(coro,), name=name, daemon=True)
+        thread.start()
+        self.threads += [thread]
+
+    def runUntil(self, predicate, timeout, interval=10):
+        # same as SimulatedEngine.runUntil, in real seconds. predicate() is checked every 10ms
+        deadline = time.time() + timeout
+        while not predicate():
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+
+class _OnLoop:
+    # calls the methods of a backend on the thread of loop, and waits for their result
+    def __init__(self, backend, loop):
+        self.backend = backend
+        self.loop = loop
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            future = concurrent.futures.Future()
+
+            def run():
+                try:
+                    future.set_result(attr(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+
+            self.loop.call_soon_threadsafe(run)
+            return future.result()
+
+        return call
+
+
+ENGINES = {e.name: e for e in (SimulatedEngine, ThreadSimulatedEngine)}
+
+
+class FakeCluster:
+    # Answers the calls KubernetesInterface makes to AppsV1Api and CoreV1Api from memory, and pushes watch
+    # events to the informers subscribed to it. A deployment controller brings the pods and the status of
+    # a deployment to its spec rolloutDelay virtual seconds after every change of its spec.
+    # Stored objects are replaced on every change, never mutated, as informers share them.
+    def __init__(self, loop, rolloutDelay=10):
+        self.loop = loop
+        self.rolloutDelay = rolloutDelay
+        self.deployments = {}  # (namespace, name) -> V1Deployment
+        self.pods = {}  # (namespace, name) -> V1Pod
+        self.podsByName = {}  # name -> V1Pod, of every namespace
+        self.owned = collections.defaultdict(set)  # (namespace, deployment) -> names of its pods
+        self.subscribers = collections.defaultdict(list)  # (namespace, kind) -> handle of informers
+        self.requests = collections.Counter()  # API method -> calls received
+        self.crashing = set()  # images whose containers restart
+        self.serializer = client.ApiClient()
+        self.resourceVersions = itertools.count(1)
+        self.podIds = itertools.count(1)
+
+    def subscribe(self, namespace, kind, handle):
+        self.subscribers[(namespace, kind)] += [handle]
+
+    def add(self, deployment):
+        # creates a deployment without counting it as a request, to set up a simulation
+        self._create(deployment)
+        self.requests.clear()
+
+    def setImage(self, namespace, name, image):
+        # what a CI pipeline does to release a new version, also not counted as a request
+        data = self._dump(self._get(namespace, name))
+        for container in data["spec"]["template"]["spec"]["containers"]:
+            container["image"] = image
+        self._update(namespace, name, data)
+
+    # AppsV1Api
+
+    def list_namespaced_deployment(self, namespace, **kwargs):
+        self.requests["list_namespaced_deployment"] += 1
+        items = [d for (ns, _), d in self.deployments.items() if ns == namespace]
+        return client.V1DeploymentList(items=items, metadata=client.V1ListMeta(resource_version=self._version()))
+
+    def read_namespaced_deployment(self, name, namespace, **kwargs):
+        self.requests["read_namespaced_deployment"] += 1
+        return copy.deepcopy(self._get(namespace, name))
+
+    def create_namespaced_deployment(self, namespace, body, **kwargs):
+        self.requests["create_namespaced_deployment"] += 1
+        if (namespace, body.metadata.name) in self.deployments:
+            raise ApiException(status=409, reason=f"deployments {body.metadata.name} already exists")
+        body = copy.deepcopy(body)
+        body.metadata.namespace = namespace
+        return copy.deepcopy(self._create(body))
+
+    def replace_namespaced_deployment(self, name, namespace, body, **kwargs):
+        self.requests["replace_namespaced_deployment"] += 1
+        return copy.deepcopy(self._update(namespace, name, self._dump(body)))
+
+    def patch_namespaced_deployment(self, name, namespace, body, **kwargs):
+        # a list is a JSON patch, a dict a merge patch
+        self.requests["patch_namespaced_deployment"] += 1
+        data = self._dump(self._get(namespace, name))
+        if isinstance(body, list):
+            _jsonPatch(data, body)
+        else:
+            _mergePatch(data, body)
+        return copy.deepcopy(self._update(namespace, name, data))
+
+    # CoreV1Api
+
+    def list_namespaced_pod(self, namespace, **kwargs):
+        self.requests["list_namespaced_pod"] += 1
+        items = [p for (ns, _), p in self.pods.items() if ns == namespace]
+        return client.V1PodList(items=items, metadata=client.V1ListMeta(resource_version=self._version()))
+
+    # pods seen by FakePrometheus
+
+    def images(self, pod):
+        # images of a pod of any namespace, None if there is no such pod
+        pod = self.podsByName.get(pod)
+        if pod is None:
+            return None
+        return [status.image for status in pod.status.container_statuses]
+
+    def _get(self, namespace, name):
+        deployment = self.deployments.get((namespace, name))
+        if deployment is None:
+            raise ApiException(status=404, reason=f'deployments "{name}" not found')
+        return deployment
+
+    def _create(self, deployment):
+        data = self._dump(deployment)
+        metadata = data["metadata"]
+        metadata.update(uid=str(uuid.uuid4()), generation=1, resourceVersion=self._version())
+        data["status"] = {}
+        deployment = self._load(data, "V1Deployment")
+        key = (metadata["namespace"], metadata["name"])
+        self.deployments[key] = deployment
+        self._emit(key[0], "deployments", "ADDED", deployment)
+        self.loop.call_later(self.rolloutDelay, self._reconcile, key)
+        return deployment
+
+    def _update(self, namespace, name, data):
+        # stores data as the new version of the deployment. Writes based on an outdated resourceVersion
+        # are refused, the status is the controller's, a change of the spec moves the generation
+        current = self._dump(self._get(namespace, name))
+        metadata = data["metadata"]
+        if (
+            metadata.get("resourceVersion", current["metadata"]["resourceVersion"])
+            != current["metadata"]["resourceVersion"]
+        ):
+            raise ApiException(status=409, reason=f'Operation cannot be fulfilled on deployments "{name}"')
+        changed = data["spec"] != current["spec"]
+        metadata.update(
+            uid=current["metadata"]["uid"],
+            generation=current["metadata"]["generation"] + changed,
+            resourceVersion=self._version(),
+        )
+        data["status"] = current.get("status", {})
+        deployment = self._load(data, "V1Deployment")
+        self.deployments[(namespace, name)] = deployment
+        self._emit(namespace, "deployments", "MODIFIED", deployment)
+        if changed:
+            self.loop.call_later(self.rolloutDelay, self._reconcile, (namespace, name))
+        return deployment
+
+    def _reconcile(self, key):
+        # replaces the pods of older specs by pods of the current one, and reports it in the status
+        namespace, name = key
+        deployment = self.deployments[key]
+        template = self._dump(deployment.spec.template)
+        revision = hashlib.sha1(json.dumps(template, sort_keys=True).encode()).hexdigest()[:10]
+        pods = self.owned[key]
+        for pod in sorted(pods):
+            if self.pods[(namespace, pod)].metadata.labels["pod-template-hash"] != revision:
+                self._deletePod(namespace, pod, pods)
+        while len(pods) > deployment.spec.replicas:
+            self._deletePod(namespace, max(pods), pods)
+        while len(pods) < deployment.spec.replicas:
+            pod = self._newPod(namespace, f"{name}-{revision}-{next(self.podIds):05x}", template, revision)
+            pods.add(pod.metadata.name)
+
+        data = self._dump(deployment)
+        replicas = len(pods)
+        data["metadata"]["resourceVersion"] = self._version()
+        data["status"] = {
+            "observedGeneration": deployment.metadata.generation,
+            "replicas": replicas,
+            "updatedReplicas": replicas,
+            "readyReplicas": replicas,
+            "availableReplicas": replicas,
+        }
+        deployment = self._load(data, "V1Deployment")
+        self.deployments[key] = deployment
+        self._emit(namespace, "deployments", "MODIFIED", deployment)
+
+    def _newPod(self, namespace, name, template, revision):
+        labels = dict(template["metadata"].get("labels", {}), **{"pod-template-hash": revision})
+        statuses = [
+            client.V1ContainerStatus(
+                name=container["name"],
+                image=container["image"],
+                image_id="",
+                ready=True,
+                restart_count=int(container["image"] in self.crashing),
+            )
+            for container in template["spec"]["containers"]
+        ]
+        pod = client.V1Pod(
+            metadata=client.V1ObjectMeta(
+                name=name, namespace=namespace, labels=labels, resource_version=self._version()
+            ),
+            status=client.V1PodStatus(phase="Running", container_statuses=statuses),
+        )
+        self.pods[(namespace, name)] = pod
+        self.podsByName[name] = pod
+        self._emit(namespace, "pods", "ADDED", pod)
+        return pod
+
+    def _deletePod(self, namespace, name, pods):
+        pods.discard(name)
+        del self.podsByName[name]
+        self._emit(namespace, "pods", "DELETED", self.pods.pop((namespace, name)))
+
+    def _emit(self, namespace, kind, type, obj):
+        # events reach informers on the next turn of the loop, as they would through a watch
+        for handle in self.subscribers[(namespace, kind)]:
+            self.loop.call_soon(handle, {"type": type, "object": obj})
+
+    def _version(self):
+        return str(next(self.resourceVersions))
+
+    def _dump(self, obj):
+        return self.serializer.sanitize_for_serialization(obj)
+
+    def _load(self, data, kind):
+        return self.serializer._ApiClient__deserialize(data, kind)
+
+
+def _jsonPatch(data, ops):
+    # applies a JSON patch (RFC 6902) made of add, replace and remove operations
+    for op in ops:
+        *parents, last = [t.replace("~1", "/").replace("~0", "~") for t in op["path"].split("/")[1:]]
+        node = data
+        for token in parents:
+            node = node[int(token)] if isinstance(node, list) else node[token]
+        if isinstance(node, list):
+            last = len(node) if last == "-" else int(last)
+        if op["op"] == "remove":
+            del node[last]
+        elif op["op"] == "add" and isinstance(node, list):
+            node.insert(last, copy.deepcopy(op["value"]))
+        elif op["op"] in ("add", "replace"):
+            node[last] = copy.deepcopy(op["value"])
+        else:
+            raise ApiException(status=422, reason=f"unsupported patch operation {op['op']}")
+
+
+def _mergePatch(data, patch):
+    # applies a JSON merge patch (RFC 7386), None removes a key
+    for key, value in patch.items():
+        if value is None:
+            data.pop(key, None)
+        elif isinstance(value, dict) and isinstance(data.get(key), dict):
+            _mergePatch(data[key], value)
+        else:
+            data[key] = copy.deepcopy(value)
+
+
+# `label="pod"` and `label=~"pod-a|pod-b"` matchers of a query
+_MATCHER = re.compile(r'(\w+)\s*(=~?)\s*"((?:[^"\\]|\\.)*)"')
+
+
+class FakePrometheus:
+    # Stands for the requests.Session of PrometheusClient. Every pod of the cluster named by a query
+    # returns a sample of 1, except pods running a failing image, which return nothing
+    def __init__(self, cluster, loop):
+        self.cluster = cluster
+        self.loop = loop
+        self.failing = set()  # images whose pods have no samples
+        self.requests = collections.Counter()  # endpoint -> queries received
+
+    def post(self, url, data=None, timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.requests[endpoint] += 1
+        now = self.loop.time()
+        if data["query"] == "time()":
+            return _Response({"resultType": "scalar", "result": [now, str(now)]})
+        samples = [({label: pod}, "1") for label, pod in self._pods(data["query"]) if self._healthy(pod)]
+        if endpoint == "query_range":
+            start, end, step = (float(data[key]) for key in ("start", "end", "step"))
+            timestamps = [start + i * step for i in range(int((end - start) / step) + 1)]
+            result = [{"metric": metric, "values": [[t, value] for t in timestamps]} for metric, value in samples]
+            return _Response({"resultType": "matrix", "result": result})
+        result = [{"metric": metric, "value": [now, value]} for metric, value in samples]
+        return _Response({"resultType": "vector", "result": result})
+
+    def _pods(self, query):
+        # (label, pod) of every pod the query selects by name
+        for label, op, value in _MATCHER.findall(query):
+            if op == "=":
+                yield label, value
+            elif op == "=~":
+                for pod in value.split("|"):
+                    yield label, pod.replace("\\\\.", ".")
+
+    def _healthy(self, pod):
+        images = self.cluster.images(pod)
+        return images is not None and not self.failing.intersection(images)
+
+
+class _Response:
+    status_code = 200
+
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return {"status": "success", "data": self.data}
+
+    @property
+    def text(self):
+        return json.dumps(self.json())
+
+
+def makeDeployment(name, namespace="default", replicas=10, image="registry/service:1"):
+    labels = {"app": name}
+    return client.V1Deployment(
+        api_version="apps/v1",
+        kind="Deployment",
+        metadata=client.V1ObjectMeta(name=name, namespace=namespace, labels=labels, annotations={}),
+        spec=client.V1DeploymentSpec(
+            replicas=replicas,
+            selector=client.V1LabelSelector(match_labels=labels),
+            template=client.V1PodTemplateSpec(
+                metadata=client.V1ObjectMeta(labels=labels),
+                spec=client.V1PodSpec(containers=[client.V1Container(name="app", image=image)]),
+            ),
+        ),
+    )
+
+
+class Simulation:
+    # services BirdWatchers, each watching a deployment of replicas pods of one namespace.
+    # Rollouts wait for their turn in scheduler, a RolloutScheduler, when there is one.
+    # Services are rolled out together by train, a ReleaseTrain, when there is one.
+    # engine is "simulated", the asyncio engine on virtual time, or "threads", see ThreadSimulatedEngine
+    def __init__(
+        self,
+        services,
+        replicas=10,
+        config=SERVICE_CONFIG,
+        namespace="default",
+        rolloutDelay=10,
+        scheduler=None,
+        train=None,
+        engine="simulated",
+    ):
+        self.engine = ENGINES[engine]()
+        self.cluster = FakeCluster(self.engine.loop, rolloutDelay)
+        self.prometheus = FakePrometheus(self.cluster, self.engine.loop)
+        self.api = self.engine.serve(self.cluster)  # the cluster as the watchers call it
+        self.namespace = namespace
+        self.config = config
+        for i in range(services):
+            self.api.add(makeDeployment(f"service-{i}", namespace, replicas))
+        self.idle(rolloutDelay + 1)  # the controller starts their pods
+        self.kube = KubernetesInterface(namespace, api=self.api)
+        self.prom = PrometheusClient(
+            "http://prometheus", concurrency=1, session=self.engine.serve(self.prometheus), clock=self.engine.time
+        )
+        self.scheduler = scheduler and self.engine.adapt(scheduler)
+        self.train = train and self.engine.adapt(train)
+        self.watchers = [self.watcher(f"service-{i}") for i in range(services)]
+
+    def watcher(self, deployment):
+        # a new BirdWatcher of the service, as a replica of aviary taking it over would have
+        return BirdWatcher(
+            deployment,
+            copy.deepcopy(self.config),
+            self.engine.adapt(self.prom),
+            self.engine.adapt(self.kube),
+            self.engine,
+            self.scheduler,
+            self.train,
+        )
+
+    def start(self, concurrency=16):
+        # initCanary of every service, then their watch, as Aviary does
+        initialized = self.engine.gather([c.initCanary() for c in self.watchers], concurrency)
+        for c, ok in zip(self.watchers, initialized):
+            if ok:
+                self.engine.spawn(c.watch(), name=c.baseDeploymentName)
+        self.idle(1)  # watchers remember their base before any release
+        return all(initialized)
+
+    def release(self, image, watchers=None, timeout=24 * 3600):
+        # sets image on the deployments of watchers (all of them by default), and returns when each
+        # watcher has decided what to do with it and is done doing it.
+        # Returns how many seconds it took, or None if some were still busy after timeout seconds
+        watchers = self.watchers if watchers is None else watchers
+        start = self.engine.time()
+        for c in watchers:
+            self.api.setImage(self.namespace, c.baseDeploymentName, image)
+
+        def settled():
+            return all(not c.deploying and c.decisions and c.decisions[-1][0] >= start for c in watchers) and all(
+                c.decisions[-1][1] in OUTCOMES for c in watchers
+            )
+
+        if not self.engine.runUntil(settled, timeout):
+            return None
+        return self.engine.time() - start
+
+    def idle(self, seconds):
+        self.engine.runUntil(lambda: False, seconds, interval=seconds)
+
+    def stop(self):
+        # stops every watcher of the simulation and waits for them to return.
+        # Idle watchers take up to STOP_POLL seconds
+        for c in self.watchers:
+            c.stop()
+        self.engine.wait()
+
+
+if __name__ == "__main__":
+    services = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    failing = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    engine = sys.argv[3] if len(sys.argv) > 3 else "simulated"
+    simulation = Simulation(services, engine=engine)
+    simulation.start()
+    simulation.prometheus.failing.add("registry/service:2-bad")
+    simulation.release("registry/service:2-bad", simulation.watchers[:failing])
+    seconds = simulation.release("registry/service:2", simulation.watchers[failing:])
+    eventlog.flush()
+    for c in simulation.watchers:
+        print(c.baseDeploymentName, [decision for _, decision in c.decisions])
+    print(f"Rollouts took {seconds}s of virtual time")
+    print("Kubernetes requests", dict(simulation.cluster.requests))
+    print("Prometheus queries", dict(simulation.prometheus.requests))
@@ -0,0 +1,243 @@
+# std
+import atexit
+import contextvars
+import json
+import os
+import queue
+import threading
+import time
+
+# sekoia
+import eventlog
+
+# Spans of canary rollouts, to see where their time goes: waiting for pods, start_delay, queries or API writes.
+# A trace is one rollout of a service. BirdWatcher opens its root span with trace(), and a span for each
+# of its steps and phases with span(). API calls and queries sent meanwhile are spans of the span current
+# in their thread or task: it is held by a ContextVar, which the asyncio engine carries to its pool threads.
+# Spans outside of a trace, as those of the informers, are not recorded.
+# Once its root span ends, the whole trace is written to a file of its own by the thread of the tracer,
+# so that the event loop of the asyncio engine never waits on the disk, in the format of either:
+# - "chrome": trace events, for chrome://tracing or https://ui.perfetto.dev
+# - "otlp": the OTLP JSON encoding of OpenTelemetry, for collectors reading files, or `otel-cli`
+# Tracing is off until configure() is given a directory, span() and trace() then cost a ContextVar lookup.
+
+FORMATS = ("chrome", "otlp")
+MAX_SPANS = 100000  # spans kept per trace, those after are dropped and counted
+QUEUE_SIZE = 1000  # ended traces waiting to be written, those after are dropped and counted
+
+_current = contextvars.ContextVar("span", default=None)
+
+
+class Span:
+    __slots__ = ("trace", "name", "attributes", "id", "parent", "thread", "start", "end", "token")
+
+    def __init__(self, trace, name, attributes, parent):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+        self.id = os.urandom(8).hex()
+        self.parent = parent  # Span, None for the root of the trace
+
+    def __enter__(self):
+        self.thread = threading.current_thread().name
+        self.start = self.trace.tracer.clock()
+        self.token = _current.set(self)
+        return self
+
+    def __exit__(self, kind, error, tb):
+        self.end = self.trace.tracer.clock()
+        _current.reset(self.token)
+        if kind is not None:
+            self.attributes["error"] = f"{kind.__name__}: {error}"
+        self.trace.finish(self)
+
+
+class _Trace:
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self.id = os.urandom(16).hex()
+        self.spans = []  # ended spans, the root last
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def finish(self, span):
+        with self.lock:
+            if len(self.spans) < MAX_SPANS:
+                self.spans += [span]
+            else:
+                self.dropped += 1
+        if span.parent is None:
+            self.tracer.write(self, span)
+
+
+class _NoSpan:
+    # stands for a span that isn't recorded
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, tb):
+        pass
+
+
+_NOSPAN = _NoSpan()
+
+
+class Tracer:
+    def __init__(self, directory, format="chrome", keep=200, clock=time.time):
+        if format not in FORMATS:
+            raise ValueError(f"tracing format must be one of {', '.join(FORMATS)}, not {format}")
+        self.directory = directory
+        self.format = format
+        self.keep = keep  # trace files kept in directory, the oldest are removed
+        self.clock = clock  # seconds since the epoch, see simulator.py
+        self.queue = queue.Queue(QUEUE_SIZE)  # (trace, root) to write
+        self.dropped = 0  # traces lost since the last one written
+        os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name="tracer", daemon=True)
+        self.thread.start()
+
+    def write(self, trace, root):
+        # queues the trace once its root span ended
+        try:
+            self.queue.put_nowait((trace, root))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            trace, root = self.queue.get()
+            try:
+                self._write(trace, root)
+            except Exception as e:
+                eventlog.warn("Tracer", f"Couldn't write trace {trace.id}: {e}")  # the next ones may still be
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        # waits until every queued trace is written
+        self.queue.join()
+
+    def _write(self, trace, root):
+        # writes the trace, then removes the oldest files past keep
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            eventlog.warn("Tracer", f"Dropped {dropped} traces, they ended faster than they could be written")
+        name = "-".join(str(root.attributes.get(key, "")) for key in ("service", "rollout"))
+        path = os.path.join(self.directory, f"{name.strip('-') or root.name}-{trace.id[:8]}.{self.format}.json")
+        document = self.chrome(trace) if self.format == "chrome" else self.otlp(trace)
+        with open(path + ".tmp", "w") as f:
+            json.dump(document, f, default=str)
+        os.replace(path + ".tmp", path)
+        # only trace files count, other files of directory are left alone
+        files = sorted(
+            (entry.stat().st_mtime, entry.path)
+            for entry in os.scandir(self.directory)
+            if entry.name.endswith(tuple(f".{format}.json" for format in FORMATS))
+        )
+        for _, old in files[: max(0, len(files) - self.keep)]:
+            os.remove(old)
+
+    def chrome(self, trace):
+        # complete events ("X"), one track per thread, timestamps in microseconds
+        threads = {}
+        events = []
+        for span in trace.spans:
+            tid = threads.setdefault(span.thread, len(threads) + 1)
+            events += [
+                {
+                    "name": span.name,
+                    "ph": "X",
+                    "pid": 1,
+                    "tid": tid,
+                    "ts": round(span.start * 1e6),
+                    "dur": round((span.end - span.start) * 1e6),
+                    "args": span.attributes,
+                }
+            ]
+        root = trace.spans[-1]
+        process = f"{root.name} {' '.join(str(value) for value in root.attributes.values())}"
+        events += [{"name": "process_name", "ph": "M", "pid": 1, "args": {"name": process}}]
+        events += [
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": thread}}
+            for thread, tid in threads.items()
+        ]
+        return {"traceEvents": events, "otherData": {"traceId": trace.id, "droppedSpans": trace.dropped}}
+
+    def otlp(self, trace):
+        # an ExportTraceServiceRequest, as OTLP/HTTP sends it with JSON encoding
+        spans = []
+        for span in trace.spans:
+            attributes = dict(span.attributes, **{"thread.name": span.thread})
+            spans += [
+                {
+                    "traceId": trace.id,
+                    "spanId": span.id,
+                    "parentSpanId": span.parent.id if span.parent is not None else "",
+                    "name": span.name,
+                    "kind": 1,  # SPAN_KIND_INTERNAL
+                    "startTimeUnixNano": str(round(span.start * 1e9)),
+                    "endTimeUnixNano": str(round(span.end * 1e9)),
+                    "attributes": [{"key": key, "value": _otlpValue(value)} for key, value in attributes.items()],
+                    "status": {"code": 2, "message": span.attributes["error"]} if "error" in span.attributes else {},
+                }
+            ]
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "aviary"}}]},
+                    "scopeSpans": [{"scope": {"name": "aviary"}, "spans": spans}],
+                }
+            ]
+        }
+
+
+def _otlpValue(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+_tracer = None
+
+
+def configure(directory=None, format="chrome", keep=200, clock=time.time):
+    # starts writing traces to directory, None stops tracing
+    global _tracer
+    flush()
+    _tracer = Tracer(directory, format, keep, clock) if directory else None
+    return _tracer
+
+
+def flush():
+    # waits until every ended trace is written
+    if _tracer is not None:
+        _tracer.flush()
+
+
+def trace(name, **attributes):
+    # the root span of a new trace, to be used as a context manager
+    if _tracer is None:
+        return _NOSPAN
+    return Span(_Trace(_tracer), name, attributes, None)
+
+
+def span(name, **attributes):
+    # a span of the current trace, to be used as a context manager. Not recorded outside of a trace
+    parent = _current.get()
+    if parent is None:
+        return _NOSPAN
+    return Span(parent.trace, name, attributes, parent)
+
+
+def annotate(**attributes):
+    # adds attributes to the current span, if any
+    current = _current.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+atexit.register(flush)
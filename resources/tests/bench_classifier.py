@@ -0,0 +1,76 @@
+# Micro-benchmark of the change classifier of BirdWatcher.shouldDeploy against the
+# DeepDiff based implementation it replaced, on deployments with large pod templates.
+# Needs deepdiff on top of the requirements of aviary: pip install deepdiff
+#
+#   python resources/tests/bench_classifier.py
+
+from deepdiff import DeepDiff
+from kubernetes import client
+
+import copy
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "python"))
+from classifier import ChangeClassifier  # noqa: E402
+
+
+def makeDeployment(containers, envs):
+    def container(i):
+        return client.V1Container(
+            name=f"c{i}",
+            image="registry/service:1.0",
+            env=[client.V1EnvVar(name=f"VAR_{j}", value=f"value-{j}") for j in range(envs)],
+            ports=[client.V1ContainerPort(container_port=8000 + j) for j in range(5)],
+            resources=client.V1ResourceRequirements(requests={"cpu": "100m", "memory": "128Mi"}),
+        )
+
+    return client.V1Deployment(
+        metadata=client.V1ObjectMeta(
+            name="service", resource_version="1", generation=1, labels={"app": "service"}, annotations={}
+        ),
+        spec=client.V1DeploymentSpec(
+            replicas=10,
+            selector=client.V1LabelSelector(match_labels={"app": "service"}),
+            template=client.V1PodTemplateSpec(
+                metadata=client.V1ObjectMeta(labels={"app": "service"}),
+                spec=client.V1PodSpec(
+                    containers=[container(i) for i in range(containers)],
+                    volumes=[client.V1Volume(name=f"v{i}", empty_dir={}) for i in range(containers)],
+                ),
+            ),
+        ),
+    )
+
+
+def legacy(old, new):
+    # the part of the former shouldDeploy that dominated its cost
+    return old.spec != new.spec and DeepDiff(old, new)
+
+
+def fingerprinted(classifier, serializer, old, new):
+    return classifier.classify(
+        classifier.fingerprint(serializer.sanitize_for_serialization(old)),
+        classifier.fingerprint(serializer.sanitize_for_serialization(new)),
+    )
+
+
+if __name__ == "__main__":
+    classifier = ChangeClassifier()
+    serializer = client.ApiClient()
+    print(f"{'containers':>10} {'env vars':>8} {'DeepDiff':>12} {'classifier':>12} {'speedup':>8}")
+    for containers, envs in [(1, 10), (5, 50), (10, 200), (20, 500)]:
+        old = makeDeployment(containers, envs)
+        new = copy.deepcopy(old)
+        new.metadata.generation = 2
+        new.spec.template.spec.containers[-1].image = "registry/service:2.0"
+        assert fingerprinted(classifier, serializer, old, new) == "canary"
+
+        runs = 3
+        deepdiff = min(timeit.repeat(lambda: legacy(old, new), number=1, repeat=runs))
+        fingerprint = min(timeit.repeat(lambda: fingerprinted(classifier, serializer, old, new), number=1, repeat=runs))
+        print(
+            f"{containers:>10} {envs:>8} {deepdiff * 1000:>10.2f}ms {fingerprint * 1000:>10.2f}ms "
+            f"{deepdiff / fingerprint:>7.1f}x"
+        )
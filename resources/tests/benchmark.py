@@ -0,0 +1,78 @@
+# Benchmark of the control loop against the fake cluster and Prometheus of python/simulator.py,
+# as the number of services grows. Every size runs in a process of its own, on virtual time:
+# - init: initCanary of every service, primary and canary deployments are created
+# - idle: ten minutes without any change
+# - rollout: a new image for every service, until every canary rollout is promoted
+# and reports, per managed service, the API calls and queries sent, the CPU time used,
+# and the memory held once every rollout is over.
+#
+#   python resources/tests/benchmark.py [sizes ...]
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "python"))
+
+SIZES = (10, 100, 1000, 5000)
+IDLE = 600  # virtual seconds
+
+
+def measure(simulation, phase):
+    # runs phase and returns what it cost
+    requests = sum(simulation.cluster.requests.values())
+    queries = sum(simulation.prometheus.requests.values())
+    virtual, wall, cpu = simulation.engine.time(), time.perf_counter(), time.process_time()
+    phase()
+    return {
+        "virtual": simulation.engine.time() - virtual,
+        "wall": time.perf_counter() - wall,
+        "cpu": time.process_time() - cpu,
+        "requests": sum(simulation.cluster.requests.values()) - requests,
+        "queries": sum(simulation.prometheus.requests.values()) - queries,
+    }
+
+
+def run(services):
+    # one size, in the current process. Prints its results as JSON
+    import eventlog
+    from simulator import Simulation
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(os.devnull, "w") as devnull:
+        eventlog.configure(devnull)
+        simulation = Simulation(services)
+        results = {
+            "init": measure(simulation, simulation.start),
+            "idle": measure(simulation, lambda: simulation.idle(IDLE)),
+            "rollout": measure(simulation, lambda: simulation.release("registry/service:2")),
+        }
+        eventlog.flush()
+    results["memory"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline  # KiB on Linux
+    results["promoted"] = sum(c.decisions[-1][1] == "promoted" for c in simulation.watchers)
+    print(json.dumps(results))
+
+
+def report(services, results):
+    print(f"{services} services, {results['promoted']} promoted, {results['memory'] / services:.0f} KiB per service")
+    print(f"  {'phase':<8} {'virtual':>9} {'wall':>8} {'cpu/svc':>9} {'calls/svc':>10} {'queries/svc':>12}")
+    for phase in ("init", "idle", "rollout"):
+        r = results[phase]
+        print(
+            f"  {phase:<8} {r['virtual']:>8.0f}s {r['wall']:>7.2f}s {r['cpu'] / services * 1000:>7.2f}ms "
+            f"{r['requests'] / services:>10.1f} {r['queries'] / services:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--run":
+        run(int(sys.argv[2]))
+        sys.exit()
+    for services in [int(size) for size in sys.argv[1:]] or SIZES:
+        out = subprocess.run(
+            [sys.executable, __file__, "--run", str(services)], stdout=subprocess.PIPE, check=True
+        ).stdout
+        report(services, json.loads(out))
@@ -0,0 +1,149 @@
+# Canary rollouts of python/simulator.py whose outcome is asserted, on every engine: the asyncio engine on
+# virtual time, and the threads engine in real time. Durations are short enough for the threads engine,
+# a few seconds per scenario:
+# - promote: a healthy version goes through its steps and replaces the primary
+# - rollback: a version failing its checks, or whose pods restart, is rolled back
+# - stop: a watcher stopped during a rollout returns at once, without writing anything after that
+# - resume: a watcher taking a stopped rollout over resumes it from its checkpoint, and promotes it
+# Exits with 1 if a scenario failed.
+#
+#   python resources/tests/scenarios.py [engines ...]
+
+import io
+import os
+import sys
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "python"))
+
+import eventlog  # noqa: E402
+from birdwatcher import CHECKPOINT  # noqa: E402
+from simulator import ENGINES, Simulation  # noqa: E402
+
+# 4 replicas, steps of 1 canary up to 2. Plain numbers are seconds
+CONFIG = {
+    "breakpoint": "50%",
+    "step": "25%",
+    "abort": 5,
+    "max_step_duration": 0.6,
+    "check_max_failures": 1,
+    "check_success_step_duration": 0.2,
+    "start_delay": 0,
+    "success": [{"expr": 'sum by (pod) (rate(http_requests_total{pod="<<pod>>", code!~"5.."}[1m])) > 0'}],
+}
+TIMEOUT = 30  # seconds a rollout may take, real or virtual
+OLD, NEW = "registry/service:1", "registry/service:2"
+
+
+def image(sim, name):
+    return sim.cluster.deployments[(sim.namespace, name)].spec.template.spec.containers[0].image
+
+
+def replicas(sim, name):
+    return sim.cluster.deployments[(sim.namespace, name)].spec.replicas
+
+
+def checkpoint(sim, c):
+    return (sim.cluster.deployments[(sim.namespace, c.canaryName)].metadata.annotations or {}).get(CHECKPOINT)
+
+
+def decision(c):
+    return c.decisions[-1][1] if c.decisions else None
+
+
+def assertSettled(sim, c, running):
+    # the primary runs running with every replica, no canary and no rollout left
+    assert image(sim, c.primaryName) == running, image(sim, c.primaryName)
+    assert replicas(sim, c.primaryName) == 4, replicas(sim, c.primaryName)
+    assert replicas(sim, c.canaryName) == 0, replicas(sim, c.canaryName)
+    assert replicas(sim, c.baseDeploymentName) == 0, replicas(sim, c.baseDeploymentName)
+    assert checkpoint(sim, c) is None, checkpoint(sim, c)
+
+
+def midRollout(sim, c):
+    # runs until the rollout checks its first step
+    reached = sim.engine.runUntil(lambda: c.progress is not None and "stepStart" in c.progress, TIMEOUT, interval=0.1)
+    assert reached, "the rollout never reached its checks"
+
+
+def promote(sim):
+    c = sim.watchers[0]
+    assert sim.release(NEW, timeout=TIMEOUT) is not None, "the rollout didn't end"
+    assert decision(c) == "promoted", decision(c)
+    assertSettled(sim, c, NEW)
+
+
+def rollback(sim):
+    c = sim.watchers[0]
+    sim.prometheus.failing.add(NEW)
+    assert sim.release(NEW, timeout=TIMEOUT) is not None, "the rollout didn't end"
+    assert decision(c) == "rolled back", decision(c)
+    assertSettled(sim, c, OLD)
+    assert image(sim, c.baseDeploymentName) == OLD, image(sim, c.baseDeploymentName)
+
+
+def crash(sim):
+    c = sim.watchers[0]
+    sim.cluster.crashing.add(NEW)
+    assert sim.release(NEW, timeout=TIMEOUT) is not None, "the rollout didn't end"
+    assert decision(c) == "rolled back", decision(c)
+    assert any("Canary pod failing" in event["message"] for event in c.events), "no pod fault was seen"
+    assertSettled(sim, c, OLD)
+
+
+def stop(sim):
+    c = sim.watchers[0]
+    sim.api.setImage(sim.namespace, c.baseDeploymentName, NEW)
+    midRollout(sim, c)
+    saved = checkpoint(sim, c)
+    c.stop()
+    assert sim.engine.runUntil(lambda: not c.deploying, 1, interval=0.01), "the rollout went on after stop"
+    writes = {method: n for method, n in sim.cluster.requests.items() if not method.startswith(("read", "list"))}
+    sim.idle(2 * CONFIG["max_step_duration"])
+    after = {method: n for method, n in sim.cluster.requests.items() if not method.startswith(("read", "list"))}
+    assert after == writes, f"wrote {after} after stop, {writes} before"
+    assert checkpoint(sim, c) == saved, "the checkpoint changed after stop"
+    assert decision(c) != "rolled back", "a stopped rollout was rolled back"
+
+
+def resume(sim):
+    c = sim.watchers[0]
+    sim.api.setImage(sim.namespace, c.baseDeploymentName, NEW)
+    midRollout(sim, c)
+    c.stop()
+    assert sim.engine.runUntil(lambda: not c.deploying, 1, interval=0.01), "the rollout went on after stop"
+    # a longer downtime than a step, its checks are run again all the same
+    sim.idle(2 * CONFIG["max_step_duration"])
+    n = sim.watcher(c.baseDeploymentName)
+    sim.watchers += [n]  # stopped with the others once done
+    assert sim.engine.run(n.initCanary()), "initCanary failed"
+    assert n.resume is not None, "no checkpoint to resume"
+    queries = sum(sim.prometheus.requests.values())
+    sim.engine.spawn(n.watch(), name=n.baseDeploymentName)
+    settled = sim.engine.runUntil(lambda: decision(n) is not None and not n.deploying, TIMEOUT, interval=0.1)
+    assert settled, "the resumed rollout didn't end"
+    assert decision(n) == "promoted", decision(n)
+    assert any(event["message"].startswith("Resuming") for event in n.events), "the rollout started over"
+    assert sum(sim.prometheus.requests.values()) > queries, "the resumed rollout wasn't checked"
+    assertSettled(sim, n, NEW)
+
+
+SCENARIOS = (promote, rollback, crash, stop, resume)
+
+if __name__ == "__main__":
+    eventlog.configure(io.StringIO())
+    failed = 0
+    for engine in sys.argv[1:] or list(ENGINES):
+        for scenario in SCENARIOS:
+            sim = Simulation(1, replicas=4, config=CONFIG, rolloutDelay=0.05, engine=engine)
+            try:
+                assert sim.start(), "initCanary failed"
+                scenario(sim)
+                print(f"{engine:<10} {scenario.__name__:<10} ok")
+            except Exception:
+                failed += 1
+                print(f"{engine:<10} {scenario.__name__:<10} FAILED")
+                traceback.print_exc()
+            finally:
+                sim.stop()
+    sys.exit(1 if failed else 0)